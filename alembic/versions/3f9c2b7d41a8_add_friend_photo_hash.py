@@ -0,0 +1,30 @@
+"""Add friend photo hash
+
+Revision ID: 3f9c2b7d41a8
+Revises: e724dd38efb4
+Create Date: 2026-10-19 14:05:12.418305
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9c2b7d41a8'
+down_revision: Union[str, Sequence[str], None] = 'e724dd38efb4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('friends', sa.Column('photo_hash', sa.BigInteger(), nullable=True))
+    op.create_index(op.f('ix_friends_photo_hash'), 'friends', ['photo_hash'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_friends_photo_hash'), table_name='friends')
+    op.drop_column('friends', 'photo_hash')
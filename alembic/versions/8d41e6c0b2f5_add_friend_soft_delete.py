@@ -0,0 +1,33 @@
+"""Add friend soft delete
+
+Revision ID: 8d41e6c0b2f5
+Revises: 3f9c2b7d41a8
+Create Date: 2026-10-19 16:42:37.901254
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8d41e6c0b2f5'
+down_revision: Union[str, Sequence[str], None] = '3f9c2b7d41a8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('friends', sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=True))
+    op.create_index(
+        'ix_friends_active_id', 'friends', ['id'], unique=False,
+        postgresql_where=sa.text('deleted_at IS NULL'),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_friends_active_id', table_name='friends', postgresql_where=sa.text('deleted_at IS NULL'))
+    op.drop_column('friends', 'deleted_at')
@@ -0,0 +1,30 @@
+"""Add friend photo_updated_at
+
+Revision ID: b7e2a9c4d013
+Revises: 8d41e6c0b2f5
+Create Date: 2026-10-19 18:05:12.417390
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e2a9c4d013'
+down_revision: Union[str, Sequence[str], None] = '8d41e6c0b2f5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('friends', sa.Column('photo_updated_at', sa.DateTime(timezone=True), nullable=True))
+    op.create_index(op.f('ix_friends_photo_updated_at'), 'friends', ['photo_updated_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_friends_photo_updated_at'), table_name='friends')
+    op.drop_column('friends', 'photo_updated_at')
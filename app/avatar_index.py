@@ -0,0 +1,188 @@
+import threading
+import time
+from datetime import UTC
+from datetime import datetime
+from pathlib import Path
+from typing import BinaryIO
+
+import models
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+# Seconds a skipped id is re-read before it is taken for a rolled back insert. Replaced avatars are
+# re-read for as long, since their UPDATE may commit (or its clock run) that far behind
+HOLE_TTL = 300.0
+# Only gaps this close to the newest id are tracked; older ones cannot belong to open transactions
+MAX_TRACKED_HOLES = 1000
+
+
+def dhash(source: str | Path | BinaryIO) -> int | None:
+    # Pillow is only needed for uploads, so it is not imported at startup
+    from PIL import Image
+    from PIL import UnidentifiedImageError
+
+    try:
+        with Image.open(source) as image:
+            pixels = list(
+                image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BILINEAR).getdata()
+            )
+    except (UnidentifiedImageError, OSError):
+        return None
+
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def to_signed(value: int) -> int:
+    # Postgres BIGINT is signed, so the top bit is stored as the sign
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def to_unsigned(value: int) -> int:
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    def __init__(self) -> None:
+        # node: [hash, ids, {distance: child}]
+        self.root: list | None = None
+        self.size = 0
+
+    def add(self, value: int, item_id: int) -> None:
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item_id], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item_id)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item_id], {}]
+                return
+            node = child
+
+    def search(self, value: int, max_distance: int) -> list[tuple[int, int]]:
+        results = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                results.extend((item_id, distance) for item_id in node[1])
+            # Triangle inequality: only children within [d - r, d + r] can hold matches
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return sorted(results, key=lambda match: (match[1], match[0]))
+
+
+class AvatarIndex:
+    def __init__(self, clock=time.monotonic, wall_clock=time.time) -> None:
+        self.tree = BKTree()
+        self.max_id = 0
+        # Ids below max_id that were not committed yet when a sync passed them -> when first missed.
+        # Sequence ids can commit out of order, so these are re-read until they show up or expire
+        self.holes: dict[int, float] = {}
+        # Ids above max_id this worker already inserted itself
+        self.inserted: set[int] = set()
+        # (id, hash) pairs in the tree, so rows that are read again are not added twice
+        self.indexed: set[tuple[int, int]] = set()
+        # Wall time of the last sync; avatars replaced since then (minus HOLE_TTL) are read again
+        self.synced_at: float | None = None
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.lock = threading.Lock()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.tree = BKTree()
+            self.max_id = 0
+            self.holes = {}
+            self.inserted = set()
+            self.indexed = set()
+            self.synced_at = None
+
+    def index(self, friend_id: int, value: int) -> None:
+        # Callers hold the lock
+        if (friend_id, value) not in self.indexed:
+            self.indexed.add((friend_id, value))
+            self.tree.add(value, friend_id)
+
+    def sync(self, db: Session) -> None:
+        # Picks up rows written by other workers since the last call: new ids, the holes left behind
+        # and avatars replaced by PATCH
+        with self.lock:
+            max_id = self.max_id
+            holes = list(self.holes)
+            synced_at = self.synced_at
+        started_at = self.wall_clock()
+        condition = models.Friend.id > max_id
+        if holes:
+            condition = or_(condition, models.Friend.id.in_(holes))
+        if synced_at is not None:
+            updated_since = datetime.fromtimestamp(synced_at - HOLE_TTL, UTC)
+            condition = or_(condition, models.Friend.photo_updated_at >= updated_since)
+        rows = db.query(models.Friend.id, models.Friend.photo_hash).filter(condition).order_by(models.Friend.id).all()
+
+        with self.lock:
+            now = self.clock()
+            previous_max = self.max_id
+            found = set()
+            for friend_id, photo_hash in rows:
+                if friend_id <= previous_max and self.holes.pop(friend_id, None) is None:
+                    # Already seen; only a replaced avatar can add anything new
+                    if photo_hash is not None:
+                        self.index(friend_id, to_unsigned(photo_hash))
+                    continue
+                found.add(friend_id)
+                if photo_hash is not None and friend_id not in self.inserted:
+                    self.index(friend_id, to_unsigned(photo_hash))
+            self.max_id = max([previous_max, *found])
+            for friend_id in range(max(previous_max + 1, self.max_id - MAX_TRACKED_HOLES), self.max_id):
+                if friend_id not in found and friend_id not in self.inserted:
+                    self.holes[friend_id] = now
+            self.inserted = {friend_id for friend_id in self.inserted if friend_id > self.max_id}
+            # A hole that stays empty this long belonged to a rolled back transaction
+            self.holes = {
+                friend_id: missed_at for friend_id, missed_at in self.holes.items() if now - missed_at < HOLE_TTL
+            }
+            self.synced_at = started_at
+
+    def insert(self, friend_id: int, value: int) -> None:
+        # Called right after this worker commits a row, so its own rows never depend on sync
+        with self.lock:
+            if self.holes.pop(friend_id, None) is None:
+                if friend_id <= self.max_id:
+                    # A sync already read the committed row
+                    return
+                self.inserted.add(friend_id)
+            self.index(friend_id, value)
+
+    def add(self, friend_id: int, value: int) -> None:
+        # Replaced avatars keep their old entry too; callers re-check matches against the table
+        with self.lock:
+            self.index(friend_id, value)
+
+    def similar(self, db: Session, value: int, max_distance: int, exclude_id: int | None = None) -> list[tuple[int, int]]:
+        self.sync(db)
+        with self.lock:
+            matches = self.tree.search(value, max_distance)
+        return [(friend_id, distance) for friend_id, distance in matches if friend_id != exclude_id]
+
+
+avatar_index = AvatarIndex()
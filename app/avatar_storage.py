@@ -0,0 +1,266 @@
+import argparse
+import fcntl
+import os
+import time
+import uuid
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from dataclasses import field
+from pathlib import Path
+from typing import IO
+
+import models
+from config import settings
+from database import SessionLocal
+from database import get_engine
+from sqlalchemy.orm import Session
+
+SHARD_WIDTH = 2
+
+
+def shard_dirs(name: str) -> list[str]:
+    # uuid4 hex digits are uniformly distributed, so each shard level splits the files evenly
+    digits = name.replace("-", "")
+    return [digits[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH] for level in range(settings.AVATAR_SHARD_DEPTH)]
+
+
+def new_avatar_path(extension: str) -> str:
+    name = f"{uuid.uuid4()}{extension}"
+    return "/".join([*shard_dirs(name), name])
+
+
+def sharded_path(relative_path: str) -> str:
+    name = relative_path.rsplit("/", 1)[-1]
+    return "/".join([*shard_dirs(name), name])
+
+
+def url_for(relative_path: str) -> str:
+    return f"{settings.AVATAR_URL_PREFIX}/{relative_path}"
+
+
+def relative_path_for(photo_url: str) -> str | None:
+    prefix = f"{settings.AVATAR_URL_PREFIX}/"
+    if not photo_url.startswith(prefix):
+        return None
+    return photo_url[len(prefix):]
+
+
+def iter_files(root: Path) -> Iterator[os.DirEntry]:
+    # scandir keeps one directory listing in memory at a time, even for a huge flat directory
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(Path(entry.path))
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry
+        except FileNotFoundError:
+            continue
+
+
+def batched(items, size: int):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_friend_photos(db: Session, batch_size: int) -> Iterator[list[tuple[int, str]]]:
+    # Keyset pagination: each batch is an index range scan, no matter how far in we are
+    last_id = 0
+    while True:
+        rows = (
+            db.query(models.Friend.id, models.Friend.photo_url)
+            .filter(models.Friend.id > last_id, models.Friend.photo_url.isnot(None))
+            .order_by(models.Friend.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def release_avatar(photo_url: str) -> None:
+    relative_path = relative_path_for(photo_url)
+    if relative_path is None:
+        return
+    try:
+        (Path(settings.AVATAR_DIR) / relative_path).unlink(missing_ok=True)
+    except OSError as e:
+        # Left for the reconciliation run to pick up as an orphan
+        print(f"Could not release avatar {photo_url}: {e}")
+
+
+@dataclass
+class ReconcileReport:
+    scanned_files: int = 0
+    orphans: list[str] = field(default_factory=list)
+    dangling: list[tuple[int, str]] = field(default_factory=list)
+
+
+def remove_orphan(path: Path, relative_path: str, action: str) -> None:
+    if action == "delete":
+        path.unlink(missing_ok=True)
+    elif action == "quarantine":
+        target = settings.AVATAR_QUARANTINE_DIR / relative_path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            path.rename(target)
+        except FileNotFoundError:
+            pass
+
+
+def reconcile(db: Session, action: str = "report", min_age: float = 3600, batch_size: int = 500) -> ReconcileReport:
+    report = ReconcileReport()
+    avatar_dir = Path(settings.AVATAR_DIR)
+    # Files younger than min_age may belong to an upload whose row is not committed yet
+    cutoff = time.time() - min_age
+
+    candidates = (
+        entry for entry in iter_files(avatar_dir)
+        if entry.stat(follow_symlinks=False).st_mtime < cutoff
+    )
+    for batch in batched(candidates, batch_size):
+        report.scanned_files += len(batch)
+        urls = {url_for(Path(entry.path).relative_to(avatar_dir).as_posix()): entry for entry in batch}
+        referenced = {
+            photo_url for (photo_url,) in
+            db.query(models.Friend.photo_url).filter(models.Friend.photo_url.in_(list(urls))).all()
+        }
+        for photo_url, entry in urls.items():
+            if photo_url not in referenced:
+                relative_path = relative_path_for(photo_url)
+                report.orphans.append(relative_path)
+                remove_orphan(Path(entry.path), relative_path, action)
+
+    for rows in iter_friend_photos(db, batch_size):
+        for friend_id, photo_url in rows:
+            relative_path = relative_path_for(photo_url)
+            if relative_path is None or not (avatar_dir / relative_path).is_file():
+                report.dangling.append((friend_id, photo_url))
+
+    return report
+
+
+def migrate_to_sharded(db: Session, batch_size: int = 500) -> int:
+    avatar_dir = Path(settings.AVATAR_DIR)
+    migrated = 0
+    for rows in iter_friend_photos(db, batch_size):
+        moves = []
+        for friend_id, photo_url in rows:
+            relative_path = relative_path_for(photo_url)
+            if relative_path is None:
+                continue
+            target_path = sharded_path(relative_path)
+            source = avatar_dir / relative_path
+            if target_path == relative_path or not source.is_file():
+                continue
+            target = avatar_dir / target_path
+            target.parent.mkdir(parents=True, exist_ok=True)
+            source.rename(target)
+            moves.append((friend_id, source, target, url_for(target_path)))
+
+        if not moves:
+            continue
+        try:
+            for friend_id, _, _, new_url in moves:
+                db.query(models.Friend).filter(models.Friend.id == friend_id).update(
+                    {models.Friend.photo_url: new_url}, synchronize_session=False
+                )
+            db.commit()
+        except Exception:
+            db.rollback()
+            # Put the files back so the rows keep pointing at them
+            for _, source, target, _ in moves:
+                target.rename(source)
+            raise
+        migrated += len(moves)
+    return migrated
+
+
+@contextmanager
+def reconcile_lock(blocking: bool = True) -> Iterator[IO | None]:
+    # Serializes the API's periodic runs and the CLI, so a file is never quarantined while
+    # migrate_to_sharded has moved it but not yet committed its new URL
+    settings.AVATAR_RECONCILE_LOCK_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with open(settings.AVATAR_RECONCILE_LOCK_FILE, "a+") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield None
+            return
+        try:
+            yield lock_file
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def run_periodic_reconcile() -> None:
+    with reconcile_lock(blocking=False) as lock_file:
+        if lock_file is None:
+            return
+        # Every Gunicorn worker schedules this; the start time of the last run, kept in the lock file,
+        # lets only one of them scan per interval
+        lock_file.seek(0)
+        try:
+            last_run = float(lock_file.read())
+        except ValueError:
+            last_run = 0.0
+        now = time.time()
+        if now - last_run < settings.AVATAR_RECONCILE_INTERVAL:
+            return
+        lock_file.truncate(0)
+        lock_file.write(str(now))
+        lock_file.flush()
+        db = SessionLocal(bind=get_engine())
+        try:
+            report = reconcile(db, action=settings.AVATAR_RECONCILE_ACTION, min_age=settings.AVATAR_ORPHAN_MIN_AGE)
+            if report.orphans or report.dangling:
+                print(
+                    f"Avatar reconciliation: {len(report.orphans)} orphan files ({settings.AVATAR_RECONCILE_ACTION}), "
+                    f"{len(report.dangling)} dangling references"
+                )
+        finally:
+            db.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Reconcile avatar files with friends.photo_url")
+    parser.add_argument("--action", choices=["report", "quarantine", "delete"], default="report",
+                        help="what to do with orphan files (default: only report them)")
+    parser.add_argument("--min-age", type=float, default=settings.AVATAR_ORPHAN_MIN_AGE,
+                        help="ignore files modified less than this many seconds ago")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--migrate-layout", action="store_true",
+                        help="move avatars into the sharded directory layout before reconciling")
+    args = parser.parse_args()
+
+    db = SessionLocal(bind=get_engine())
+    try:
+        with reconcile_lock():
+            if args.migrate_layout:
+                print(f"Moved {migrate_to_sharded(db, args.batch_size)} avatars into the sharded layout")
+            report = reconcile(db, action=args.action, min_age=args.min_age, batch_size=args.batch_size)
+    finally:
+        db.close()
+
+    print(f"Scanned {report.scanned_files} files")
+    print(f"Orphan files ({args.action}): {len(report.orphans)}")
+    for relative_path in report.orphans:
+        print(f"  {relative_path}")
+    print(f"Dangling references: {len(report.dangling)}")
+    for friend_id, photo_url in report.dangling:
+        print(f"  friend {friend_id}: {photo_url}")
+
+
+if __name__ == "__main__":
+    main()
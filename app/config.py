@@ -1,4 +1,6 @@
+from functools import lru_cache
 from pathlib import Path
+from typing import Literal
 
 from pydantic import ConfigDict
 from pydantic_settings import BaseSettings
@@ -10,14 +12,69 @@ class Settings(BaseSettings):
     database_password: str
     database_name: str
     database_user: str
+    database_replica_urls: list[str] = []
+    # Overrides the URL built from the fields above, e.g. a SQLite file for local tooling
+    database_url: str | None = None
+    DATABASE_POOL_SIZE: int = 5
+    DATABASE_MAX_OVERFLOW: int = 10
+    # Connections all Gunicorn workers of one instance may open together; Postgres allows 100 by default
+    DATABASE_MAX_CONNECTIONS: int = 80
+    REPLICA_HEALTH_CHECK_INTERVAL: float = 5.0
+    REPLICA_CONNECT_TIMEOUT: int = 2
+    READ_YOUR_WRITES_WINDOW: float = 5.0
+    SQL_PROFILING_ENABLED: bool = False
+    SQL_SLOW_QUERY_MS: float = 200.0
+    SQL_EXPLAIN_SLOW_QUERIES: bool = True
+    SQL_N_PLUS_ONE_THRESHOLD: int = 5
 
 
     BASE_DIR: Path = Path(__file__).resolve().parent.parent
     UPLOAD_BASE_DIR: Path = BASE_DIR / "uploads"
     AVATAR_DIR: Path = UPLOAD_BASE_DIR / "avatars"
     AVATAR_URL_PREFIX: str = "/media"
+    AVATAR_SHARD_DEPTH: int = 2
+    AVATAR_QUARANTINE_DIR: Path = UPLOAD_BASE_DIR / "quarantine"
+    AVATAR_ORPHAN_MIN_AGE: float = 3600.0
+    AVATAR_RECONCILE_INTERVAL: float = 0.0
+    AVATAR_RECONCILE_ACTION: Literal["report", "quarantine", "delete"] = "quarantine"
+    AVATAR_RECONCILE_LOCK_FILE: Path = UPLOAD_BASE_DIR / ".reconcile.lock"
+    MAX_BATCH_IDS: int = 500
+
+    UPLOAD_MAX_BODY_SIZE: int = 10 * 1024 * 1024
+    UPLOAD_SPOOL_THRESHOLD: int = 256 * 1024
+    UPLOAD_MAX_PART_SIZE: int = 64 * 1024
+    UPLOAD_MAX_FIELDS: int = 10
+    UPLOAD_MAX_FILES: int = 1
+    UPLOAD_COPY_CHUNK_SIZE: int = 64 * 1024
+
+    DUPLICATE_HASH_DISTANCE: int = 6
+    SIMILAR_HASH_DISTANCE: int = 12
+
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMIT_CLIENT_RATE: float = 10.0
+    RATE_LIMIT_CLIENT_BURST: float = 20.0
+    RATE_LIMIT_GLOBAL_RATE: float = 200.0
+    RATE_LIMIT_GLOBAL_BURST: float = 400.0
+    RATE_LIMIT_REDIS_URL: str | None = None
+    RATE_LIMIT_TRUST_FORWARDED: bool = False
+    RATE_LIMIT_TRUSTED_PROXY_COUNT: int = 1
+    # Requests with one of these in X-API-Key skip the per-client bucket
+    RATE_LIMIT_TRUSTED_API_KEYS: list[str] = []
+    ROUTE_CONCURRENCY_LIMITS: dict[str, int] = {"POST /friends": 4, "PATCH /friends/{id}": 4}
+    ROUTE_QUEUE_SIZE: int = 16
+    ROUTE_QUEUE_TIMEOUT: float = 5.0
 
     model_config = ConfigDict(env_file=".env", extra="ignore")
 
 
-settings = Settings()
+@lru_cache
+def get_settings() -> Settings:
+    return Settings()
+
+
+def __getattr__(name: str):
+    # `settings` is built on first access, so importing models or database (alembic, scripts) does not
+    # validate it. Modules doing `from config import settings` at the top, main included, still build it at import
+    if name == "settings":
+        return get_settings()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,33 +1,261 @@
+import itertools
+import math
 import os
+import threading
+import time
 
-from config import settings
+import profiling
+from config import get_settings
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
+from starlette.requests import Request
+from starlette.responses import Response
 
-SQLALCHEMY_DATABASE_URL = (
-    f'postgresql://{settings.database_user}:{settings.database_password}'
-    f'@{settings.database_hostname}:{settings.database_port}/{settings.database_name}'
-)
+READ_YOUR_WRITES_COOKIE = "last_write"
 
 
-# Avoid importing psycopg2 during tests; use in-memory SQLite under pytest
-try:
-    if os.getenv("PYTEST_CURRENT_TEST"):
-        engine = create_engine("sqlite://")
-    else:
-        engine = create_engine(SQLALCHEMY_DATABASE_URL)
-except ModuleNotFoundError:
-    # Fallback when postgres driver isn't installed (e.g., during tests)
-    engine = create_engine("sqlite://")
+def database_url() -> str:
+    settings = get_settings()
+    if settings.database_url:
+        return settings.database_url
+    return (
+        f'postgresql://{settings.database_user}:{settings.database_password}'
+        f'@{settings.database_hostname}:{settings.database_port}/{settings.database_name}'
+    )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def create_primary_engine() -> Engine:
+    settings = get_settings()
+    # Avoid importing psycopg2 during tests; use in-memory SQLite under pytest
+    try:
+        if os.getenv("PYTEST_CURRENT_TEST"):
+            return with_profiling(create_engine("sqlite://"))
+        return with_profiling(create_engine(
+            database_url(),
+            pool_size=settings.DATABASE_POOL_SIZE,
+            max_overflow=settings.DATABASE_MAX_OVERFLOW,
+            pool_pre_ping=True,
+        ))
+    except ModuleNotFoundError:
+        # Fallback when postgres driver isn't installed (e.g., during tests)
+        return with_profiling(create_engine("sqlite://"))
+
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
 
 Base = declarative_base()
 
+# Engines are created on first use so importing models (alembic, scripts, tests) stays cheap
+_engine: Engine | None = None
+_replica_router = None
+_init_lock = threading.Lock()
+
+
+def get_engine() -> Engine:
+    global _engine
+    if _engine is None:
+        with _init_lock:
+            if _engine is None:
+                _engine = create_primary_engine()
+    return _engine
+
+
+def explain(connection, statement: str, parameters) -> str:
+    # Runs on the raw DBAPI cursor so the EXPLAIN itself does not go through these listeners.
+    # It shares the request's transaction, and on Postgres a failed statement aborts that
+    # transaction, so it runs inside a savepoint that is rolled back if EXPLAIN fails.
+    sqlite = connection.dialect.name == "sqlite"
+    prefix = "EXPLAIN QUERY PLAN " if sqlite else "EXPLAIN "
+    cursor = connection.connection.cursor()
+    try:
+        if not sqlite:
+            cursor.execute("SAVEPOINT sql_profiling_explain")
+        try:
+            cursor.execute(prefix + statement, parameters)
+            plan = "\n".join(" ".join(str(column) for column in row) for row in cursor.fetchall())
+        except Exception as e:
+            if not sqlite:
+                cursor.execute("ROLLBACK TO SAVEPOINT sql_profiling_explain")
+            return f"EXPLAIN failed: {e}"
+        if not sqlite:
+            cursor.execute("RELEASE SAVEPOINT sql_profiling_explain")
+        return plan
+    finally:
+        cursor.close()
+
+
+def start_query_timer(connection, cursor, statement, parameters, context, executemany):
+    if get_settings().SQL_PROFILING_ENABLED:
+        connection.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def record_query_time(connection, cursor, statement, parameters, context, executemany):
+    settings = get_settings()
+    starts = connection.info.get("query_start")
+    if not settings.SQL_PROFILING_ENABLED or not starts:
+        return
+    duration_ms = (time.perf_counter() - starts.pop()) * 1000
+    plan = None
+    if (
+        duration_ms >= settings.SQL_SLOW_QUERY_MS
+        and settings.SQL_EXPLAIN_SLOW_QUERIES
+        and not executemany
+        and statement.lstrip().upper().startswith("SELECT")
+    ):
+        plan = explain(connection, statement, parameters)
+    profiling.record_query(statement, duration_ms, plan)
+
+
+def enable_query_profiling(target: Engine) -> None:
+    event.listen(target, "before_cursor_execute", start_query_timer)
+    event.listen(target, "after_cursor_execute", record_query_time)
+
+
+def with_profiling(target: Engine) -> Engine:
+    # Listeners go on the app's own engines only, so scripts and alembic that build their own engine
+    # after importing models never need the app settings
+    if get_settings().SQL_PROFILING_ENABLED:
+        enable_query_profiling(target)
+    return target
+
+
+class ReplicaRouter:
+    def __init__(self, primary: Engine, replicas: list[Engine], health_check_interval: float,
+                 read_your_writes_window: float, clock=time.monotonic, wall_clock=time.time) -> None:
+        self.primary = primary
+        self.replicas = replicas
+        self.health_check_interval = health_check_interval
+        self.read_your_writes_window = read_your_writes_window
+        self.clock = clock
+        self.wall_clock = wall_clock
+        # engine -> (healthy, checked at)
+        self.health: dict[Engine, tuple[bool, float]] = {}
+        self.probing: set[Engine] = set()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def is_healthy(self, replica: Engine) -> bool:
+        # A replica nobody has probed yet counts as down, so reads never wait on its first connect
+        healthy, checked_at = self.health.get(replica, (False, None))
+        if checked_at is None or self.clock() - checked_at >= self.health_check_interval:
+            with self.lock:
+                start = replica not in self.probing
+                self.probing.add(replica)
+            if start:
+                # Requests keep the last known state while a single background probe runs
+                threading.Thread(target=self.probe, args=(replica,), daemon=True).start()
+        return healthy
+
+    def probe(self, replica: Engine) -> None:
+        was_healthy = self.health.get(replica, (True, None))[0]
+        try:
+            with replica.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            healthy = True
+        except Exception as e:
+            if was_healthy:
+                print(f"Read replica {replica.url!r} failed its health check: {e}")
+            healthy = False
+        # Record the result before clearing the flag, or a request in between would start a second probe
+        self.health[replica] = (healthy, self.clock())
+        with self.lock:
+            self.probing.discard(replica)
+
+    def wrote_recently(self, written_at: float | None) -> bool:
+        # The cookie may come from another instance whose clock runs ahead, so some future skew is accepted
+        if written_at is None:
+            return False
+        window = self.read_your_writes_window
+        return -window < self.wall_clock() - written_at < window
+
+    def read_engine(self, written_at: float | None = None) -> Engine:
+        if not self.replicas or self.wrote_recently(written_at):
+            return self.primary
+        start = next(self.counter)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            if self.is_healthy(replica):
+                return replica
+        # Every replica is down, fall back to the primary
+        return self.primary
+
+
+def create_replica_engine(url: str) -> Engine:
+    connect_args = {}
+    if make_url(url).get_backend_name() == "postgresql":
+        # A replica that went away must fail its health check fast instead of hanging on the TCP connect
+        connect_args["connect_timeout"] = get_settings().REPLICA_CONNECT_TIMEOUT
+    return with_profiling(create_engine(url, pool_pre_ping=True, connect_args=connect_args))
+
+
+def get_replica_router() -> ReplicaRouter:
+    global _replica_router
+    if _replica_router is None:
+        settings = get_settings()
+        primary = get_engine()
+        with _init_lock:
+            if _replica_router is None:
+                _replica_router = ReplicaRouter(
+                    primary,
+                    [create_replica_engine(url) for url in settings.database_replica_urls],
+                    health_check_interval=settings.REPLICA_HEALTH_CHECK_INTERVAL,
+                    read_your_writes_window=settings.READ_YOUR_WRITES_WINDOW,
+                )
+    return _replica_router
+
+
+def warm_pool(target: Engine, size: int) -> None:
+    connections = []
+    try:
+        for _ in range(size):
+            connection = target.connect()
+            connections.append(connection)
+            connection.execute(text("SELECT 1"))
+    except Exception as e:
+        print(f"Could not warm the connection pool for {target.url!r}: {e}")
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def dispose_engines(close: bool = True) -> None:
+    if _engine is not None:
+        _engine.dispose(close=close)
+    if _replica_router is not None:
+        for replica in _replica_router.replicas:
+            replica.dispose(close=close)
+
+
+def mark_write(response: Response) -> None:
+    # The client carries its last write time, so whichever worker or instance serves its next read can honour it
+    window = get_settings().READ_YOUR_WRITES_WINDOW
+    response.set_cookie(
+        READ_YOUR_WRITES_COOKIE, f"{time.time():.3f}", max_age=math.ceil(window), httponly=True, samesite="lax"
+    )
+
+
+def last_write_time(request: Request) -> float | None:
+    try:
+        return float(request.cookies[READ_YOUR_WRITES_COOKIE])
+    except (KeyError, ValueError):
+        return None
+
 
 def get_db():
-    db = SessionLocal()
+    db = SessionLocal(bind=get_engine())
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_read_db(request: Request):
+    db = SessionLocal(bind=get_replica_router().read_engine(last_write_time(request)))
     try:
         yield db
     finally:
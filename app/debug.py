@@ -0,0 +1,18 @@
+import profiling
+from config import settings
+from fastapi import APIRouter
+from fastapi import HTTPException
+from fastapi import Query
+from starlette.status import HTTP_404_NOT_FOUND
+
+router = APIRouter(
+    prefix="/debug",
+    tags=["Debug"]
+)
+
+
+@router.get("/sql")
+def get_sql_profiles(limit: int = Query(20, ge=1, le=profiling.PROFILE_HISTORY)):
+    if not settings.SQL_PROFILING_ENABLED:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Not Found")
+    return [profile.as_dict() for profile in list(profiling.recent_profiles)[-limit:]]
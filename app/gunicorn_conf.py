@@ -0,0 +1,48 @@
+import math
+import os
+
+from config import get_settings
+
+
+def available_cpus() -> int:
+    # cpu_count() reports the host's cores; a container is limited by its cpuset and its CFS quota
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def default_workers() -> int:
+    # Async workers are not blocked on I/O, so one per core keeps all cores busy. Every worker has its own
+    # pool, so the count is also capped to keep all pools within DATABASE_MAX_CONNECTIONS
+    settings = get_settings()
+    per_worker = settings.DATABASE_POOL_SIZE + settings.DATABASE_MAX_OVERFLOW
+    return max(1, min(available_cpus(), settings.DATABASE_MAX_CONNECTIONS // per_worker))
+
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY") or default_workers())
+worker_class = "uvicorn_worker.UvicornWorker"
+preload_app = True
+
+# Give in-flight uploads time to finish on SIGTERM before the worker is killed
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.getenv("WORKER_TIMEOUT", "60"))
+keepalive = int(os.getenv("KEEPALIVE", "5"))
+max_requests = int(os.getenv("MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", "0"))
+
+accesslog = "-"
+errorlog = "-"
+
+
+def post_fork(server, worker):
+    # Connections opened in the master by preload_app must not be shared across forked workers
+    from database import dispose_engines
+
+    dispose_engines(close=False)
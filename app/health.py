@@ -0,0 +1,25 @@
+from database import get_db
+from fastapi import APIRouter
+from fastapi import Depends
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from starlette.status import HTTP_503_SERVICE_UNAVAILABLE
+
+router = APIRouter(
+    prefix="/health",
+    tags=["Health"]
+)
+
+@router.get("/live")
+def liveness():
+    return {"status": "alive"}
+
+
+@router.get("/ready")
+def readiness(db: Session = Depends(get_db)):
+    try:
+        db.execute(text("SELECT 1"))
+    except Exception as e:
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail="Database unavailable") from e
+    return {"status": "ready"}
@@ -1,11 +1,58 @@
 
+import asyncio
+from contextlib import asynccontextmanager
+
+import avatar_storage
+import debug
+import health
 import user
 from config import settings
+from database import dispose_engines
+from database import get_engine
+from database import warm_pool
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from profiling import QueryProfilingMiddleware
+from rate_limit import AdmissionControlMiddleware
+from rate_limit import build_rate_limiter
+from rate_limit import build_route_limiters
+from starlette.concurrency import run_in_threadpool
+from upload_limits import BodySizeLimitMiddleware
+
+
+async def reconcile_avatars_periodically(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(avatar_storage.run_periodic_reconcile)
+        except Exception as e:
+            print(f"Avatar reconciliation failed: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(warm_pool, get_engine(), settings.DATABASE_POOL_SIZE)
+    reconcile_task = None
+    if settings.AVATAR_RECONCILE_INTERVAL > 0:
+        reconcile_task = asyncio.create_task(reconcile_avatars_periodically(settings.AVATAR_RECONCILE_INTERVAL))
+    yield
+    if reconcile_task is not None:
+        reconcile_task.cancel()
+    if app.state.rate_limiter is not None:
+        await app.state.rate_limiter.close()
+    await run_in_threadpool(dispose_engines)
+
+
+app = FastAPI(lifespan=lifespan)
+app.state.rate_limiter = build_rate_limiter(settings)
+app.state.route_limiters = build_route_limiters(settings)
+app.state.trusted_proxies = settings.RATE_LIMIT_TRUSTED_PROXY_COUNT if settings.RATE_LIMIT_TRUST_FORWARDED else 0
+app.state.trusted_api_keys = settings.RATE_LIMIT_TRUSTED_API_KEYS
+app.add_middleware(QueryProfilingMiddleware)
+app.add_middleware(AdmissionControlMiddleware)
+app.add_middleware(BodySizeLimitMiddleware)
 
-app = FastAPI()
 origins = ["*"]
 app.add_middleware(
     CORSMiddleware,
@@ -17,6 +64,8 @@ app.add_middleware(
 
 
 app.include_router(user.router)
+app.include_router(health.router)
+app.include_router(debug.router)
 app.mount("/media", StaticFiles(directory=settings.AVATAR_DIR), name="media")
 
 
@@ -1,5 +1,8 @@
 from database import Base
+from sqlalchemy import BigInteger
 from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import String
 
@@ -11,3 +14,16 @@ class Friend(Base):
     profession = Column(String, nullable=False)
     profession_description  = Column(String, nullable=True)
     photo_url = Column(String, nullable=True)
+    photo_hash = Column(BigInteger, nullable=True, index=True)
+    deleted_at = Column(DateTime(timezone=True), nullable=True)
+    # Set when PATCH replaces the avatar, so other workers' avatar indexes pick up the new hash
+    photo_updated_at = Column(DateTime(timezone=True), nullable=True, index=True)
+
+    __table_args__ = (
+        Index(
+            'ix_friends_active_id',
+            'id',
+            postgresql_where=deleted_at.is_(None),
+            sqlite_where=deleted_at.is_(None),
+        ),
+    )
@@ -0,0 +1,108 @@
+import logging
+from collections import Counter
+from collections import deque
+from contextvars import ContextVar
+from dataclasses import dataclass
+from dataclasses import field
+
+from config import get_settings
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp
+from starlette.types import Message
+from starlette.types import Receive
+from starlette.types import Scope
+from starlette.types import Send
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HISTORY = 50
+
+
+@dataclass
+class QueryRecord:
+    statement: str
+    duration_ms: float
+    slow: bool = False
+    plan: str | None = None
+
+
+@dataclass
+class RequestProfile:
+    method: str
+    path: str
+    queries: list[QueryRecord] = field(default_factory=list)
+
+    @property
+    def total_ms(self) -> float:
+        return sum(query.duration_ms for query in self.queries)
+
+    def repeated_statements(self, threshold: int) -> dict[str, int]:
+        counts = Counter(query.statement for query in self.queries)
+        return {statement: count for statement, count in counts.items() if count >= threshold}
+
+    def as_dict(self) -> dict:
+        return {
+            "method": self.method,
+            "path": self.path,
+            "query_count": len(self.queries),
+            "total_ms": round(self.total_ms, 3),
+            "repeated_statements": self.repeated_statements(get_settings().SQL_N_PLUS_ONE_THRESHOLD),
+            "queries": [
+                {
+                    "statement": query.statement,
+                    "duration_ms": round(query.duration_ms, 3),
+                    "slow": query.slow,
+                    "plan": query.plan,
+                }
+                for query in self.queries
+            ],
+        }
+
+
+current_profile: ContextVar[RequestProfile | None] = ContextVar("current_profile", default=None)
+recent_profiles: deque[RequestProfile] = deque(maxlen=PROFILE_HISTORY)
+
+
+def record_query(statement: str, duration_ms: float, plan: str | None = None) -> None:
+    slow = duration_ms >= get_settings().SQL_SLOW_QUERY_MS
+    if slow:
+        logger.warning("Slow query (%.1f ms): %s\n%s", duration_ms, statement, plan or "")
+    profile = current_profile.get()
+    if profile is not None:
+        profile.queries.append(QueryRecord(statement, duration_ms, slow, plan))
+
+
+def report(profile: RequestProfile) -> None:
+    repeated = profile.repeated_statements(get_settings().SQL_N_PLUS_ONE_THRESHOLD)
+    for statement, count in repeated.items():
+        logger.warning("Possible N+1 in %s %s: %d x %s", profile.method, profile.path, count, statement)
+    logger.info(
+        "%s %s ran %d queries in %.1f ms", profile.method, profile.path, len(profile.queries), profile.total_ms
+    )
+
+
+class QueryProfilingMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not get_settings().SQL_PROFILING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope["method"], scope["path"])
+        token = current_profile.set(profile)
+
+        async def send_with_timing(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers["X-SQL-Query-Count"] = str(len(profile.queries))
+                headers["Server-Timing"] = f'db;dur={profile.total_ms:.1f};desc="{len(profile.queries)} queries"'
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_profile.reset(token)
+            recent_profiles.append(profile)
+            report(profile)
@@ -0,0 +1,272 @@
+import asyncio
+import hmac
+import math
+import re
+import time
+from collections import deque
+from dataclasses import dataclass
+
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import compile_path
+from starlette.status import HTTP_429_TOO_MANY_REQUESTS
+from starlette.status import HTTP_503_SERVICE_UNAVAILABLE
+
+GLOBAL_KEY = "global"
+# Probes from the orchestrator must never be throttled, or a busy pod gets restarted
+EXEMPT_PATH_PREFIXES = ("/health/",)
+API_KEY_HEADER = "x-api-key"
+
+
+@dataclass
+class Decision:
+    allowed: bool
+    retry_after: float = 0.0
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def consume(self, amount: float = 1.0) -> Decision:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return Decision(allowed=True)
+        return Decision(allowed=False, retry_after=(amount - self.tokens) / self.rate)
+
+
+class InMemoryBackend:
+    def __init__(self, max_keys: int = 10_000, clock=time.monotonic) -> None:
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets: dict[str, TokenBucket] = {}
+
+    async def consume(self, key: str, rate: float, capacity: float) -> Decision:
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                # Dicts keep insertion order, so the first key is the least recently used one
+                self.buckets.pop(next(iter(self.buckets)))
+            bucket = TokenBucket(rate, capacity, clock=self.clock)
+        self.buckets[key] = bucket
+        return bucket.consume()
+
+    async def close(self) -> None:
+        self.buckets.clear()
+
+
+# Refill and take a token atomically on the Redis side so several API workers share one bucket
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(retry_after)}
+"""
+
+
+class RedisBackend:
+    def __init__(self, url: str, prefix: str = "ratelimit:") -> None:
+        # Imported here so processes using the in-memory backend never pay for it
+        try:
+            import redis.asyncio as redis
+        except ModuleNotFoundError as e:
+            raise RuntimeError("The redis package is required for RATE_LIMIT_REDIS_URL") from e
+        self.client = redis.from_url(url)
+        self.prefix = prefix
+        self.script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    async def consume(self, key: str, rate: float, capacity: float) -> Decision:
+        allowed, retry_after = await self.script(keys=[self.prefix + key], args=[rate, capacity, time.time()])
+        return Decision(allowed=bool(allowed), retry_after=float(retry_after))
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+class RateLimiter:
+    def __init__(self, backend, client_rate: float, client_burst: float,
+                 global_rate: float, global_burst: float) -> None:
+        self.backend = backend
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+
+    async def check(self, client_key: str) -> Decision:
+        decision = await self.backend.consume(f"client:{client_key}", self.client_rate, self.client_burst)
+        if not decision.allowed:
+            return decision
+        return await self.check_global()
+
+    async def check_global(self) -> Decision:
+        return await self.backend.consume(GLOBAL_KEY, self.global_rate, self.global_burst)
+
+    async def close(self) -> None:
+        await self.backend.close()
+
+
+class ConcurrencyLimiter:
+    def __init__(self, limit: int, max_queue: int, queue_timeout: float) -> None:
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiters: deque[asyncio.Future] = deque()
+
+    async def acquire(self) -> bool:
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return True
+        if len(self.waiters) >= self.max_queue:
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+            return True
+        except (TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done():
+                # The slot was handed over just as we gave up, pass it on
+                self.release()
+            else:
+                waiter.cancel()
+                self.waiters.remove(waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return False
+
+    def release(self) -> None:
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                # The slot moves straight to the next waiter, so active stays the same
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+def client_key_from_request(request: Request, trusted_proxies: int = 0) -> str:
+    if trusted_proxies:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            # Each proxy appends the address it saw, so only the entries added by our own proxies can be
+            # trusted; anything further left was sent by the client and may be forged
+            hops = [hop.strip() for hop in forwarded.split(",")]
+            return hops[-min(trusted_proxies, len(hops))]
+    return request.client.host if request.client else "unknown"
+
+
+def is_trusted_client(request: Request, api_keys: list[str]) -> bool:
+    api_key = request.headers.get(API_KEY_HEADER)
+    return bool(api_key) and any(hmac.compare_digest(api_key, key) for key in api_keys if key)
+
+
+@dataclass
+class RouteLimit:
+    method: str
+    pattern: re.Pattern
+    limiter: ConcurrencyLimiter
+
+
+def normalize_path(path: str) -> str:
+    return path.rstrip("/") or "/"
+
+
+def find_route_limiter(route_limits: list[RouteLimit], method: str, path: str) -> ConcurrencyLimiter | None:
+    # The middleware runs before routing, so the request path is matched against the route templates here
+    path = normalize_path(path)
+    for route in route_limits:
+        if route.method == method.upper() and route.pattern.match(path):
+            return route.limiter
+    return None
+
+
+def retry_after_header(seconds: float) -> dict[str, str]:
+    return {"Retry-After": str(max(1, math.ceil(seconds)))}
+
+
+class AdmissionControlMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        if request.url.path.startswith(EXEMPT_PATH_PREFIXES):
+            return await call_next(request)
+
+        state = request.app.state
+        limiter: RateLimiter | None = getattr(state, "rate_limiter", None)
+        if limiter is not None:
+            if is_trusted_client(request, getattr(state, "trusted_api_keys", [])):
+                # Trusted services (the bot) fan many users into one connection, so only the global bucket applies
+                decision = await limiter.check_global()
+            else:
+                decision = await limiter.check(client_key_from_request(request, getattr(state, "trusted_proxies", 0)))
+            if not decision.allowed:
+                return JSONResponse(
+                    {"detail": "Too many requests"},
+                    status_code=HTTP_429_TOO_MANY_REQUESTS,
+                    headers=retry_after_header(decision.retry_after),
+                )
+
+        route_limiter = find_route_limiter(getattr(state, "route_limiters", []), request.method, request.url.path)
+        if route_limiter is None:
+            return await call_next(request)
+
+        if not await route_limiter.acquire():
+            return JSONResponse(
+                {"detail": "Server is busy, try again later"},
+                status_code=HTTP_503_SERVICE_UNAVAILABLE,
+                headers=retry_after_header(route_limiter.queue_timeout),
+            )
+        try:
+            return await call_next(request)
+        finally:
+            route_limiter.release()
+
+
+def build_rate_limiter(settings) -> RateLimiter | None:
+    if not settings.RATE_LIMIT_ENABLED:
+        return None
+    if settings.RATE_LIMIT_REDIS_URL:
+        backend = RedisBackend(settings.RATE_LIMIT_REDIS_URL)
+    else:
+        backend = InMemoryBackend()
+    return RateLimiter(
+        backend,
+        client_rate=settings.RATE_LIMIT_CLIENT_RATE,
+        client_burst=settings.RATE_LIMIT_CLIENT_BURST,
+        global_rate=settings.RATE_LIMIT_GLOBAL_RATE,
+        global_burst=settings.RATE_LIMIT_GLOBAL_BURST,
+    )
+
+
+def build_route_limiters(settings) -> list[RouteLimit]:
+    route_limits = []
+    for route, limit in settings.ROUTE_CONCURRENCY_LIMITS.items():
+        method, path = route.split(" ", 1)
+        route_limits.append(RouteLimit(
+            method=method.upper(),
+            pattern=compile_path(normalize_path(path))[0],
+            limiter=ConcurrencyLimiter(limit, settings.ROUTE_QUEUE_SIZE, settings.ROUTE_QUEUE_TIMEOUT),
+        ))
+    return route_limits
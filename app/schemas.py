@@ -1,6 +1,7 @@
 
 from pydantic import BaseModel
 from pydantic import ConfigDict
+from pydantic import Field
 
 
 class FriendBase(BaseModel):
@@ -16,3 +17,20 @@ class FriendOut(FriendBase):
     id: int
     photo_url: str | None = None
     model_config = ConfigDict(from_attributes=True)
+
+
+class FriendCreatedOut(FriendOut):
+    possible_duplicates: list[int] = []
+
+
+class SimilarFriendOut(FriendOut):
+    distance: int
+
+
+class FriendBatchIn(BaseModel):
+    ids: list[int] = Field(min_length=1)
+
+
+class FriendBatchOut(BaseModel):
+    friends: list[FriendOut]
+    missing: list[int]
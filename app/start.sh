@@ -3,5 +3,10 @@
 # Stop the script if there is an error
 #set -e
 
-# Run the FastAPI application using uvicorn
-uvicorn main:app --host 0.0.0.0 --port 8000 --reload
\ No newline at end of file
+if [ "${DEBUG:-false}" = "true" ]; then
+    # Development: single process with auto-reload
+    exec uvicorn main:app --host 0.0.0.0 --port 8000 --reload
+fi
+
+# Production: Gunicorn master with one Uvicorn worker per available core, see gunicorn_conf.py
+exec gunicorn -c gunicorn_conf.py main:app
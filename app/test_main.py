@@ -1,22 +1,53 @@
+import asyncio
 import os
 import shutil
+import subprocess
+import sys
+import time
+from datetime import UTC
+from datetime import datetime
 from pathlib import Path
+from types import SimpleNamespace
 
+import avatar_storage
+import database
+import models
+import profiling
 import pytest
 from _pytest.monkeypatch import MonkeyPatch
+from avatar_index import AvatarIndex
+from avatar_index import BKTree
+from avatar_index import avatar_index
+from avatar_storage import ReconcileReport
+from avatar_storage import migrate_to_sharded
+from avatar_storage import reconcile
 from config import settings
+from database import READ_YOUR_WRITES_COOKIE
 from database import Base
+from database import ReplicaRouter
 from database import get_db
+from database import get_read_db
 from fastapi.testclient import TestClient
 from main import app
 from PIL import Image
+from rate_limit import ConcurrencyLimiter
+from rate_limit import InMemoryBackend
+from rate_limit import RateLimiter
+from rate_limit import TokenBucket
+from rate_limit import build_route_limiters
+from rate_limit import find_route_limiter
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from starlette.datastructures import Headers
+from starlette.formparsers import MultiPartParser
+from upload_limits import BoundedMultiPartParser
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
+# The listeners check SQL_PROFILING_ENABLED on every statement, so tests can switch profiling on and off
+database.enable_query_profiling(engine)
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 TEST_FILE_DIR = Path(__file__).resolve().parent
 TEST_MEDIA_DIR = TEST_FILE_DIR / "test_media"
@@ -34,6 +65,7 @@ def override_get_db():
 
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_read_db] = override_get_db
 
 
 @pytest.fixture(scope="session", autouse=True)
@@ -62,6 +94,7 @@ def setup_and_teardown_session():
 def client():
     Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
+    avatar_index.reset()
 
     with TestClient(app) as c:
         yield c
@@ -101,8 +134,9 @@ def test_create_friend_success(client):
     assert json_data["id"] is not None
     assert "photo_url" in json_data
     assert json_data["photo_url"].startswith(settings.AVATAR_URL_PREFIX)
-    filename = json_data["photo_url"].split('/')[-1]
-    saved_file_path = os.path.join(TEST_MEDIA_DIR, filename)
+    relative_path = json_data["photo_url"][len(settings.AVATAR_URL_PREFIX) + 1:]
+    assert len(relative_path.split('/')) == settings.AVATAR_SHARD_DEPTH + 1
+    saved_file_path = os.path.join(TEST_MEDIA_DIR, relative_path)
     assert os.path.exists(saved_file_path)
 
 
@@ -139,3 +173,479 @@ def test_get_friend_by_id(client):
     response_404 = client.get("/friends/9999")
     assert response_404.status_code == 404
 
+
+def test_token_bucket_refills_over_time():
+    now = [0.0]
+    bucket = TokenBucket(rate=1.0, capacity=2.0, clock=lambda: now[0])
+    assert bucket.consume().allowed
+    assert bucket.consume().allowed
+    decision = bucket.consume()
+    assert not decision.allowed
+    assert decision.retry_after == pytest.approx(1.0)
+    now[0] = 1.0
+    assert bucket.consume().allowed
+
+
+def test_rate_limit_returns_429_with_retry_after(client, monkeypatch):
+    limiter = RateLimiter(InMemoryBackend(), client_rate=0.5, client_burst=2,
+                          global_rate=100, global_burst=100)
+    monkeypatch.setattr(app.state, "rate_limiter", limiter)
+    assert client.get("/friends/").status_code == 200
+    assert client.get("/friends/").status_code == 200
+    response = client.get("/friends/")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+
+
+def test_rate_limit_uses_rightmost_forwarded_hop_and_lets_trusted_key_through(client, monkeypatch):
+    limiter = RateLimiter(InMemoryBackend(), client_rate=0.5, client_burst=1,
+                          global_rate=100, global_burst=100)
+    monkeypatch.setattr(app.state, "rate_limiter", limiter)
+    monkeypatch.setattr(app.state, "trusted_proxies", 1)
+    monkeypatch.setattr(app.state, "trusted_api_keys", ["bot-key"])
+
+    # A forged leftmost entry must not give the client a fresh bucket
+    assert client.get("/friends/", headers={"X-Forwarded-For": "1.1.1.1, 10.0.0.7"}).status_code == 200
+    assert client.get("/friends/", headers={"X-Forwarded-For": "2.2.2.2, 10.0.0.7"}).status_code == 429
+    assert client.get("/friends/", headers={"X-Forwarded-For": "10.0.0.8"}).status_code == 200
+
+    headers = {"X-Forwarded-For": "10.0.0.7", "X-API-Key": "bot-key"}
+    assert all(client.get("/friends/", headers=headers).status_code == 200 for _ in range(5))
+    headers["X-API-Key"] = "wrong-key"
+    assert client.get("/friends/", headers=headers).status_code == 429
+
+
+def test_concurrency_limiter_rejects_when_queue_full():
+    async def scenario():
+        limiter = ConcurrencyLimiter(limit=1, max_queue=1, queue_timeout=0.05)
+        assert await limiter.acquire()
+        queued = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        assert not await limiter.acquire()
+        limiter.release()
+        assert await queued
+        limiter.release()
+        assert limiter.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_route_limits_match_path_templates(client, monkeypatch):
+    route_limits = build_route_limiters(SimpleNamespace(
+        ROUTE_CONCURRENCY_LIMITS={"POST /friends": 1, "PATCH /friends/{id}": 1},
+        ROUTE_QUEUE_SIZE=0,
+        ROUTE_QUEUE_TIMEOUT=0.05,
+    ))
+    monkeypatch.setattr(app.state, "route_limiters", route_limits)
+    upload_limit, edit_limit = (route.limiter for route in route_limits)
+    assert find_route_limiter(route_limits, "post", "/friends/") is upload_limit
+    assert find_route_limiter(route_limits, "PATCH", "/friends/42/") is edit_limit
+    assert find_route_limiter(route_limits, "GET", "/friends/42") is None
+    assert find_route_limiter(route_limits, "PATCH", "/friends/42/similar") is None
+
+    edit_limit.active = 1
+    response = client.patch("/friends/1", data={"name": "Busy"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert client.get("/friends/1").status_code == 404
+
+
+def test_replica_router_routes_reads_and_fails_over(tmp_path):
+    primary = create_engine(f"sqlite:///{tmp_path / 'primary.db'}")
+    replica = create_engine(f"sqlite:///{tmp_path / 'replica.db'}")
+    now = [0.0]
+    router = ReplicaRouter(primary, [replica], health_check_interval=5,
+                           read_your_writes_window=2, clock=lambda: now[0], wall_clock=lambda: 100.0)
+
+    router.probe(replica)
+    assert router.read_engine() is replica
+    assert router.read_engine(written_at=99.0) is primary
+    assert router.read_engine(written_at=97.0) is replica
+    # Another instance's clock running slightly ahead still counts as a recent write
+    assert router.read_engine(written_at=100.5) is primary
+    assert router.read_engine(written_at=103.0) is replica
+
+    broken = create_engine(f"sqlite:///{tmp_path / 'missing' / 'replica.db'}")
+    router = ReplicaRouter(primary, [broken], health_check_interval=5,
+                           read_your_writes_window=2, clock=lambda: now[0])
+    # Unprobed replicas are skipped while the first background check runs
+    assert router.read_engine() is primary
+    router.probe(broken)
+    assert router.health[broken][0] is False
+    assert router.read_engine() is primary
+
+
+def test_reads_go_to_replica_until_client_writes(client, monkeypatch, tmp_path):
+    replica = create_engine(f"sqlite:///{tmp_path / 'replica.db'}")
+    Base.metadata.create_all(bind=replica)
+    with replica.begin() as connection:
+        connection.execute(models.Friend.__table__.insert().values(name="Replica Only", profession="Echo"))
+    router = ReplicaRouter(engine, [replica], health_check_interval=60, read_your_writes_window=5)
+    router.probe(replica)
+    monkeypatch.setattr(database, "_replica_router", router)
+    monkeypatch.delitem(app.dependency_overrides, get_read_db)
+
+    assert [friend["name"] for friend in client.get("/friends/").json()] == ["Replica Only"]
+
+    with open(DUMMY_IMAGE_PATH, "rb") as f:
+        files = {"photo": (DUMMY_IMAGE_NAME, f, "image/jpeg")}
+        response = client.post("/friends", data={"name": "Fresh", "profession": "Writer"}, files=files)
+    assert READ_YOUR_WRITES_COOKIE in response.cookies
+    assert [friend["name"] for friend in client.get("/friends/").json()] == ["Fresh"]
+
+    client.cookies.clear()
+    assert [friend["name"] for friend in client.get("/friends/").json()] == ["Replica Only"]
+
+
+def test_health_endpoints(client):
+    assert client.get("/health/live").json() == {"status": "alive"}
+    assert client.get("/health/ready").status_code == 200
+
+
+def test_get_friends_batch_keeps_order_and_reports_missing(client):
+    ids = []
+    for name in ("Dana", "Eve"):
+        with open(DUMMY_IMAGE_PATH, "rb") as f:
+            files = {"photo": (DUMMY_IMAGE_NAME, f, "image/jpeg")}
+            response = client.post("/friends", data={"name": name, "profession": "Tester"}, files=files)
+        ids.append(response.json()["id"])
+
+    response = client.get(f"/friends/batch?ids={ids[1]},9999,{ids[0]},{ids[1]}")
+    assert response.status_code == 200
+    json_data = response.json()
+    assert [friend["name"] for friend in json_data["friends"]] == ["Eve", "Dana"]
+    assert json_data["missing"] == [9999]
+
+    response = client.post("/friends/batch", json={"ids": [ids[0], 12345]})
+    assert response.status_code == 200
+    assert [friend["id"] for friend in response.json()["friends"]] == [ids[0]]
+    assert response.json()["missing"] == [12345]
+
+    assert client.get("/friends/batch?ids=1,abc").status_code == 422
+
+
+def test_bk_tree_search_matches_linear_scan():
+    values = [0, 0b1, 0b11, 0b1111, 0xFF, 0xFFFF, 0xF0F0, 2**63, 2**64 - 1]
+    tree = BKTree()
+    for item_id, value in enumerate(values):
+        tree.add(value, item_id)
+
+    for radius in (0, 2, 8):
+        expected = sorted(
+            ((item_id, (value ^ 0b111).bit_count()) for item_id, value in enumerate(values)
+             if (value ^ 0b111).bit_count() <= radius),
+            key=lambda match: (match[1], match[0]),
+        )
+        assert tree.search(0b111, radius) == expected
+
+
+def test_avatar_index_picks_up_ids_committed_out_of_order(client):
+    index = AvatarIndex()
+    db = TestingSessionLocal()
+    try:
+        for friend_id in (1, 2):
+            db.add(models.Friend(id=friend_id, name="Early", profession="Test", photo_hash=0b1))
+        db.commit()
+        index.sync(db)
+
+        # Row 4 commits first, then a sync runs, then row 3 commits
+        db.add(models.Friend(id=4, name="Fast", profession="Test", photo_hash=0b11))
+        db.commit()
+        index.sync(db)
+        assert index.holes.keys() == {3}
+        db.add(models.Friend(id=3, name="Slow", profession="Test", photo_hash=0b111))
+        db.commit()
+
+        assert [friend_id for friend_id, _ in index.similar(db, 0b111, 0)] == [3]
+        assert index.holes == {}
+        # This worker's own insert is not indexed a second time by the next sync
+        db.add(models.Friend(id=5, name="Own", profession="Test", photo_hash=0b1111))
+        db.commit()
+        index.insert(5, 0b1111)
+        assert index.similar(db, 0b1111, 0) == [(5, 0)]
+    finally:
+        db.close()
+
+
+def test_avatar_index_picks_up_avatars_replaced_by_another_worker(client):
+    worker_1, worker_2 = AvatarIndex(), AvatarIndex()
+    db = TestingSessionLocal()
+    try:
+        for friend_id in (1, 2):
+            db.add(models.Friend(id=friend_id, name="Pic", profession="Test", photo_hash=0b1))
+        db.commit()
+        worker_1.sync(db)
+        worker_2.sync(db)
+
+        # Worker 1 serves the PATCH that replaces friend 2's avatar
+        friend = db.get(models.Friend, 2)
+        friend.photo_hash = 0
+        friend.photo_updated_at = datetime.now(UTC)
+        db.commit()
+        worker_1.add(2, 0)
+
+        assert worker_1.similar(db, 0, 0) == [(2, 0)]
+        assert worker_2.similar(db, 0, 0) == [(2, 0)]
+        # Rows read again within the update window are not added to the tree twice
+        size = worker_2.tree.size
+        worker_2.similar(db, 0, 0)
+        assert worker_2.tree.size == size == 3
+    finally:
+        db.close()
+
+
+def test_near_duplicate_avatars_are_flagged_and_listed_as_similar(client, tmp_path):
+    fractal = Image.effect_mandelbrot((256, 256), (-2.0, -1.5, 1.0, 1.5), 100).convert("RGB")
+    fractal.save(tmp_path / "original.jpg", "JPEG", quality=95)
+    fractal.resize((128, 128)).save(tmp_path / "resized.jpg", "JPEG", quality=60)
+    fractal.transpose(Image.Transpose.FLIP_LEFT_RIGHT).save(tmp_path / "other.jpg", "JPEG")
+
+    created = []
+    for name in ("original.jpg", "resized.jpg", "other.jpg"):
+        with open(tmp_path / name, "rb") as f:
+            files = {"photo": (name, f, "image/jpeg")}
+            response = client.post("/friends", data={"name": name, "profession": "Model"}, files=files)
+        assert response.status_code == 201
+        created.append(response.json())
+
+    assert created[0]["possible_duplicates"] == []
+    assert created[1]["possible_duplicates"] == [created[0]["id"]]
+    assert created[2]["possible_duplicates"] == []
+
+    response = client.get(f"/friends/{created[0]['id']}/similar")
+    assert response.status_code == 200
+    assert [friend["id"] for friend in response.json()] == [created[1]["id"]]
+    assert client.get("/friends/9999/similar").status_code == 404
+
+
+def test_update_friend_changes_fields_and_replaces_avatar(client, tmp_path):
+    with open(DUMMY_IMAGE_PATH, "rb") as f:
+        files = {"photo": (DUMMY_IMAGE_NAME, f, "image/jpeg")}
+        data = {"name": "Dana", "profession": "Pilot", "profession_description": "Flies planes"}
+        created = client.post("/friends", data=data, files=files).json()
+    old_file = Path(TEST_MEDIA_DIR) / created["photo_url"][len(settings.AVATAR_URL_PREFIX) + 1:]
+
+    response = client.patch(f"/friends/{created['id']}", data={"profession": "Captain"})
+    assert response.status_code == 200
+    assert response.json()["name"] == "Dana"
+    assert response.json()["profession"] == "Captain"
+    assert response.json()["profession_description"] == "Flies planes"
+    assert response.json()["photo_url"] == created["photo_url"]
+
+    Image.effect_mandelbrot((64, 64), (-2.0, -1.5, 1.0, 1.5), 50).convert("RGB").save(tmp_path / "new.jpg", "JPEG")
+    with open(tmp_path / "new.jpg", "rb") as f:
+        files = {"photo": ("new.jpg", f, "image/jpeg")}
+        response = client.patch(f"/friends/{created['id']}", data={"profession_description": ""}, files=files)
+    assert response.status_code == 200
+    assert response.json()["profession_description"] is None
+    assert response.json()["photo_url"] != created["photo_url"]
+    assert not old_file.exists()
+    assert (Path(TEST_MEDIA_DIR) / response.json()["photo_url"][len(settings.AVATAR_URL_PREFIX) + 1:]).exists()
+
+    assert client.patch("/friends/9999", data={"name": "Nobody"}).status_code == 404
+
+
+def test_delete_friend_hides_row_and_keeps_avatar(client):
+    ids = []
+    for name in ("Eve", "Frank"):
+        with open(DUMMY_IMAGE_PATH, "rb") as f:
+            files = {"photo": (DUMMY_IMAGE_NAME, f, "image/jpeg")}
+            ids.append(client.post("/friends", data={"name": name, "profession": "Spy"}, files=files).json()["id"])
+    photo_url = client.get(f"/friends/{ids[0]}").json()["photo_url"]
+
+    response = client.delete(f"/friends/{ids[0]}")
+    assert response.status_code == 204
+    assert (Path(TEST_MEDIA_DIR) / photo_url[len(settings.AVATAR_URL_PREFIX) + 1:]).exists()
+
+    assert client.get(f"/friends/{ids[0]}").status_code == 404
+    assert [friend["id"] for friend in client.get("/friends").json()] == [ids[1]]
+    assert client.get("/friends/batch", params={"ids": f"{ids[0]},{ids[1]}"}).json()["missing"] == [ids[0]]
+    assert client.patch(f"/friends/{ids[0]}", data={"name": "Back"}).status_code == 404
+    assert client.delete(f"/friends/{ids[0]}").status_code == 404
+
+    db = TestingSessionLocal()
+    try:
+        deleted = db.query(models.Friend).filter(models.Friend.id == ids[0]).one()
+        assert deleted.deleted_at is not None
+        assert deleted.photo_url == photo_url
+    finally:
+        db.close()
+
+
+def test_upload_rejected_early_by_content_length(client, monkeypatch):
+    monkeypatch.setattr(settings, "UPLOAD_MAX_BODY_SIZE", 100)
+    with open(DUMMY_IMAGE_PATH, "rb") as f:
+        files = {"photo": (DUMMY_IMAGE_NAME, f, "image/jpeg")}
+        response = client.post("/friends/", data={"name": "Big", "profession": "Tester"}, files=files)
+    assert response.status_code == 413
+    assert client.get("/friends/").json() == []
+
+
+def test_upload_rejected_when_streamed_body_exceeds_limit(client, monkeypatch):
+    monkeypatch.setattr(settings, "UPLOAD_MAX_BODY_SIZE", 300)
+
+    def chunks():
+        yield b'--b\r\nContent-Disposition: form-data; name="photo"; filename="a.jpg"\r\n\r\n'
+        for _ in range(4):
+            yield b"x" * 100
+
+    response = client.post("/friends/", content=chunks(), headers={"Content-Type": "multipart/form-data; boundary=b"})
+    assert response.status_code == 413
+
+
+def test_upload_rejected_with_too_many_fields(client, monkeypatch):
+    monkeypatch.setattr(settings, "UPLOAD_MAX_FIELDS", 2)
+    with open(DUMMY_IMAGE_PATH, "rb") as f:
+        files = {"photo": (DUMMY_IMAGE_NAME, f, "image/jpeg")}
+        data = {"name": "Many", "profession": "Tester", "profession_description": "Too many"}
+        response = client.post("/friends/", data=data, files=files)
+    assert response.status_code == 400
+
+
+def test_spool_threshold_is_set_per_parser_without_patching_starlette(monkeypatch):
+    monkeypatch.setattr(settings, "UPLOAD_SPOOL_THRESHOLD", 1234)
+
+    async def stream():
+        yield b""
+
+    parser = BoundedMultiPartParser(Headers({"content-type": "multipart/form-data; boundary=x"}), stream())
+    assert parser.spool_max_size == 1234
+    assert MultiPartParser.spool_max_size == 1024 * 1024
+
+
+def test_reconcile_finds_orphans_and_dangling_references(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "AVATAR_DIR", tmp_path / "avatars")
+    monkeypatch.setattr(settings, "AVATAR_QUARANTINE_DIR", tmp_path / "quarantine")
+    with open(DUMMY_IMAGE_PATH, "rb") as f:
+        files = {"photo": (DUMMY_IMAGE_NAME, f, "image/jpeg")}
+        kept = client.post("/friends", data={"name": "Kept", "profession": "Tester"}, files=files).json()
+    with open(DUMMY_IMAGE_PATH, "rb") as f:
+        files = {"photo": (DUMMY_IMAGE_NAME, f, "image/jpeg")}
+        lost = client.post("/friends", data={"name": "Lost", "profession": "Tester"}, files=files).json()
+    (settings.AVATAR_DIR / lost["photo_url"][len("/media/"):]).unlink()
+    orphan = settings.AVATAR_DIR / "ab" / "cd" / "orphan.jpg"
+    orphan.parent.mkdir(parents=True)
+    orphan.write_bytes(b"orphan")
+
+    db = TestingSessionLocal()
+    try:
+        report = reconcile(db, action="quarantine", min_age=0, batch_size=1)
+    finally:
+        db.close()
+
+    assert report.scanned_files == 2
+    assert report.orphans == ["ab/cd/orphan.jpg"]
+    assert report.dangling == [(lost["id"], lost["photo_url"])]
+    assert not orphan.exists()
+    assert (settings.AVATAR_QUARANTINE_DIR / "ab" / "cd" / "orphan.jpg").exists()
+    assert (settings.AVATAR_DIR / kept["photo_url"][len("/media/"):]).exists()
+
+
+def test_periodic_reconcile_runs_once_per_interval_and_yields_to_the_cli(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "AVATAR_RECONCILE_LOCK_FILE", tmp_path / ".reconcile.lock")
+    monkeypatch.setattr(settings, "AVATAR_RECONCILE_INTERVAL", 60.0)
+    runs = []
+    monkeypatch.setattr(avatar_storage, "reconcile", lambda db, **kwargs: runs.append(kwargs) or ReconcileReport())
+
+    # The CLI (or another worker mid-run) holds the lock, so this worker skips its turn
+    with avatar_storage.reconcile_lock():
+        avatar_storage.run_periodic_reconcile()
+    assert runs == []
+
+    # A second worker ticking within the same interval sees the first one's run in the lock file
+    avatar_storage.run_periodic_reconcile()
+    avatar_storage.run_periodic_reconcile()
+    assert len(runs) == 1
+
+    settings.AVATAR_RECONCILE_LOCK_FILE.write_text(str(time.time() - 61))
+    avatar_storage.run_periodic_reconcile()
+    assert len(runs) == 2
+
+
+def test_migrate_to_sharded_moves_flat_avatars(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "AVATAR_DIR", tmp_path)
+    (tmp_path / "0a1b2c3d.jpg").write_bytes(b"flat")
+    db = TestingSessionLocal()
+    try:
+        db.add(models.Friend(name="Flat", profession="Tester", photo_url="/media/0a1b2c3d.jpg"))
+        db.commit()
+
+        assert migrate_to_sharded(db) == 1
+        assert db.query(models.Friend).one().photo_url == "/media/0a/1b/0a1b2c3d.jpg"
+    finally:
+        db.close()
+    assert (tmp_path / "0a" / "1b" / "0a1b2c3d.jpg").read_bytes() == b"flat"
+    assert not (tmp_path / "0a1b2c3d.jpg").exists()
+
+
+def test_sql_profiling_headers_slow_queries_and_n_plus_one(client, monkeypatch):
+    assert client.get("/debug/sql").status_code == 404
+    assert "X-SQL-Query-Count" not in client.get("/friends/").headers
+
+    monkeypatch.setattr(settings, "SQL_PROFILING_ENABLED", True)
+    monkeypatch.setattr(settings, "SQL_SLOW_QUERY_MS", 0)
+    monkeypatch.setattr(settings, "SQL_N_PLUS_ONE_THRESHOLD", 3)
+    profiling.recent_profiles.clear()
+
+    response = client.get("/friends/")
+    assert response.headers["X-SQL-Query-Count"] == "1"
+    assert response.headers["Server-Timing"].startswith("db;dur=")
+
+    profiles = client.get("/debug/sql").json()
+    list_profile = profiles[0]
+    assert list_profile["path"] == "/friends/"
+    assert list_profile["query_count"] == 1
+    query = list_profile["queries"][0]
+    assert query["statement"].startswith("SELECT")
+    assert query["slow"] is True
+    assert query["plan"]
+    assert client.get("/debug/sql", params={"limit": 0}).status_code == 422
+
+    profile = profiling.RequestProfile("GET", "/n-plus-one")
+    token = profiling.current_profile.set(profile)
+    db = TestingSessionLocal()
+    try:
+        for friend_id in (1, 2, 3):
+            db.query(models.Friend).filter(models.Friend.id == friend_id).first()
+    finally:
+        db.close()
+        profiling.current_profile.reset(token)
+    assert list(profile.repeated_statements(3).values()) == [3]
+
+
+def test_engines_built_outside_the_app_do_not_need_settings(tmp_path):
+    script = (
+        "import models\n"
+        "from sqlalchemy import create_engine, text\n"
+        "create_engine('sqlite://').connect().execute(text('SELECT 1'))\n"
+    )
+    env = {key: value for key, value in os.environ.items() if not key.startswith("DATABASE_")}
+    env["PYTHONPATH"] = str(TEST_FILE_DIR)
+    result = subprocess.run([sys.executable, "-c", script], cwd=tmp_path, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+
+def test_failed_explain_rolls_back_to_savepoint_on_postgres():
+    executed = []
+
+    class FakeCursor:
+        def execute(self, statement, parameters=None):
+            executed.append(statement)
+            if statement.startswith("EXPLAIN"):
+                raise RuntimeError("cannot explain")
+
+        def close(self):
+            pass
+
+    connection = SimpleNamespace(
+        dialect=SimpleNamespace(name="postgresql"),
+        connection=SimpleNamespace(cursor=FakeCursor),
+    )
+    plan = database.explain(connection, "SELECT 1", {})
+
+    assert plan == "EXPLAIN failed: cannot explain"
+    assert executed == [
+        "SAVEPOINT sql_profiling_explain",
+        "EXPLAIN SELECT 1",
+        "ROLLBACK TO SAVEPOINT sql_profiling_explain",
+    ]
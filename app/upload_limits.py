@@ -0,0 +1,107 @@
+from config import settings
+from fastapi.routing import APIRoute
+from starlette.datastructures import FormData
+from starlette.exceptions import HTTPException
+from starlette.formparsers import MultiPartException
+from starlette.formparsers import MultiPartParser
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.status import HTTP_413_CONTENT_TOO_LARGE
+from starlette.types import ASGIApp
+from starlette.types import Message
+from starlette.types import Receive
+from starlette.types import Scope
+from starlette.types import Send
+
+
+class BoundedMultiPartParser(MultiPartParser):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # Files above this size are rolled over from memory to a temp file while the body is parsed
+        self.spool_max_size = settings.UPLOAD_SPOOL_THRESHOLD
+
+
+class BoundedFormRequest(Request):
+    # FastAPI only ever awaits request.form(), so a plain coroutine is enough here
+    async def form(self, *, max_files=None, max_fields=None, max_part_size=None) -> FormData:
+        max_files = settings.UPLOAD_MAX_FILES if max_files is None else max_files
+        max_fields = settings.UPLOAD_MAX_FIELDS if max_fields is None else max_fields
+        max_part_size = settings.UPLOAD_MAX_PART_SIZE if max_part_size is None else max_part_size
+        content_type = self.headers.get("content-type", "").split(";", 1)[0].strip().lower()
+        if content_type != "multipart/form-data":
+            return await super().form(max_files=max_files, max_fields=max_fields, max_part_size=max_part_size)
+        try:
+            return await BoundedMultiPartParser(
+                self.headers, self.stream(),
+                max_files=max_files, max_fields=max_fields, max_part_size=max_part_size,
+            ).parse()
+        except MultiPartException as exc:
+            raise HTTPException(status_code=400, detail=exc.message) from exc
+
+
+class BoundedFormRoute(APIRoute):
+    def get_route_handler(self):
+        original_handler = super().get_route_handler()
+
+        async def handler(request: Request):
+            return await original_handler(BoundedFormRequest(request.scope, request.receive))
+
+        return handler
+
+
+def too_large_response() -> JSONResponse:
+    return JSONResponse(
+        {"detail": f"Request body exceeds {settings.UPLOAD_MAX_BODY_SIZE} bytes"},
+        status_code=HTTP_413_CONTENT_TOO_LARGE,
+        headers={"Connection": "close"},
+    )
+
+
+class BodySizeLimitMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        limit = settings.UPLOAD_MAX_BODY_SIZE
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            # Rejected before a single body byte is read
+            await too_large_response()(scope, receive, send)
+            return
+
+        received = 0
+        exceeded = False
+        response_started = False
+
+        async def limited_receive() -> Message:
+            # Chunked bodies or lying Content-Length headers are cut off while streaming;
+            # the app sees a disconnect and its response is replaced with a 413 below
+            nonlocal received, exceeded
+            if exceeded:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    exceeded = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message: Message) -> None:
+            nonlocal response_started
+            if exceeded and not response_started:
+                return
+            response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not exceeded or response_started:
+                raise
+        if exceeded and not response_started:
+            await too_large_response()(scope, receive, send)
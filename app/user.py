@@ -1,30 +1,67 @@
 import os
-import uuid
+import shutil
+from datetime import UTC
+from datetime import datetime
 from pathlib import Path
 
+import avatar_storage
 import models
 import schemas
+from avatar_index import avatar_index
+from avatar_index import dhash
+from avatar_index import hamming
+from avatar_index import to_signed
+from avatar_index import to_unsigned
 from config import settings
 from database import get_db
+from database import get_read_db
+from database import mark_write
 from fastapi import APIRouter
+from fastapi import BackgroundTasks
 from fastapi import Depends
 from fastapi import File
 from fastapi import Form
 from fastapi import HTTPException
+from fastapi import Query
+from fastapi import Response
 from fastapi import UploadFile
 from sqlalchemy.orm import Session
 from starlette.status import HTTP_201_CREATED
+from starlette.status import HTTP_204_NO_CONTENT
 from starlette.status import HTTP_404_NOT_FOUND
+from starlette.status import HTTP_422_UNPROCESSABLE_CONTENT
 from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR
+from upload_limits import BoundedFormRoute
 
 router = APIRouter(
     prefix="/friends",
-    tags=["Friend"]
+    tags=["Friend"],
+    route_class=BoundedFormRoute
 )
 
 
-@router.post("/", status_code=HTTP_201_CREATED, response_model=schemas.FriendOut)
+def active_friends(db: Session):
+    # Matches the partial index ix_friends_active_id, so soft-deleted rows are never scanned
+    return db.query(models.Friend).filter(models.Friend.deleted_at.is_(None))
+
+
+def save_avatar(photo: UploadFile) -> tuple[Path, str, int | None]:
+    file_extension = Path(photo.filename).suffix
+    relative_path = avatar_storage.new_avatar_path(file_extension)
+
+    file_path = settings.AVATAR_DIR / relative_path
+    os.makedirs(file_path.parent, exist_ok=True)
+
+    # Copy in chunks so a large upload never sits in memory as one bytes object
+    with open(file_path, "wb") as buffer:
+        shutil.copyfileobj(photo.file, buffer, settings.UPLOAD_COPY_CHUNK_SIZE)
+
+    return file_path, avatar_storage.url_for(relative_path), dhash(file_path)
+
+
+@router.post("/", status_code=HTTP_201_CREATED, response_model=schemas.FriendCreatedOut)
 def create_friend(
+        response: Response,
         name: str = Form(...),
         profession: str = Form(...),
         profession_description: str | None = Form(None),
@@ -32,47 +69,124 @@ def create_friend(
         photo: UploadFile = File(...)
 ):
     photo_url = None
+    photo_hash = None
+    file_path = None
+    committed = False
 
     try:
         if photo and photo.filename:
-            os.makedirs(settings.AVATAR_DIR, exist_ok=True)
-
-            file_extension = Path(photo.filename).suffix
-            unique_filename = f"{uuid.uuid4()}{file_extension}"
-
-            file_path = os.path.join(settings.AVATAR_DIR, unique_filename)
-
-            photo_url = f"{settings.AVATAR_URL_PREFIX}/{unique_filename}"
-
-            with open(file_path, "wb") as buffer:
-                content = photo.file.read()
-                buffer.write(content)
+            file_path, photo_url, photo_hash = save_avatar(photo)
 
         new_friend = models.Friend(
             name=name,
             profession=profession,
             profession_description=profession_description,
             photo_url=photo_url,
+            photo_hash=to_signed(photo_hash) if photo_hash is not None else None,
         )
 
         db.add(new_friend)
         db.commit()
+        committed = True
         db.refresh(new_friend)
+        mark_write(response)
 
-        return new_friend
+        created = schemas.FriendCreatedOut.model_validate(new_friend)
+        if photo_hash is not None:
+            avatar_index.insert(new_friend.id, photo_hash)
+            created.possible_duplicates = find_possible_duplicates(db, new_friend.id, photo_hash)
+        return created
 
     except Exception as e:
         db.rollback()
+        if file_path is not None and not committed:
+            # No row points at the file, so it would only become an orphan
+            file_path.unlink(missing_ok=True)
         print(f"Error creating friend: {e}")
         raise HTTPException(
             status_code=HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Internal server error: {str(e)}"
         ) from e
 
+
+def similar_friends(
+        db: Session, photo_hash: int, max_distance: int, exclude_id: int
+) -> list[tuple[models.Friend, int]]:
+    matches = avatar_index.similar(db, photo_hash, max_distance, exclude_id=exclude_id)
+    if not matches:
+        return []
+    rows = {
+        row.id: row
+        for row in active_friends(db).filter(models.Friend.id.in_([match_id for match_id, _ in matches])).all()
+    }
+    similar = []
+    for match_id, distance in matches:
+        row = rows.get(match_id)
+        # The in-process index may lag behind the table, so trust the stored hash over the index
+        if row is None or row.photo_hash is None or hamming(to_unsigned(row.photo_hash), photo_hash) != distance:
+            continue
+        similar.append((row, distance))
+    return similar
+
+
+def find_possible_duplicates(db: Session, friend_id: int, photo_hash: int) -> list[int]:
+    # The friend is already saved, so a failing lookup must not turn the response into an error
+    try:
+        matches = similar_friends(db, photo_hash, settings.DUPLICATE_HASH_DISTANCE, exclude_id=friend_id)
+        return [row.id for row, _ in matches]
+    except Exception as e:
+        print(f"Error looking up duplicates for friend {friend_id}: {e}")
+        return []
+
+
+def parse_ids(raw: str) -> list[int]:
+    try:
+        return [int(part) for part in raw.split(",") if part.strip()]
+    except ValueError as e:
+        raise HTTPException(
+            status_code=HTTP_422_UNPROCESSABLE_CONTENT,
+            detail="ids must be a comma-separated list of integers"
+        ) from e
+
+
+def get_friends_batch(ids: list[int], db: Session) -> schemas.FriendBatchOut:
+    # Duplicates are dropped but the first-seen order is kept
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        raise HTTPException(status_code=HTTP_422_UNPROCESSABLE_CONTENT, detail="ids must not be empty")
+    if len(ids) > settings.MAX_BATCH_IDS:
+        raise HTTPException(
+            status_code=HTTP_422_UNPROCESSABLE_CONTENT,
+            detail=f"At most {settings.MAX_BATCH_IDS} ids per request"
+        )
+    try:
+        found = {
+            friend.id: friend
+            for friend in active_friends(db).filter(models.Friend.id.in_(ids)).all()
+        }
+    except Exception as e:
+        raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR) from e
+    return schemas.FriendBatchOut(
+        friends=[found[friend_id] for friend_id in ids if friend_id in found],
+        missing=[friend_id for friend_id in ids if friend_id not in found],
+    )
+
+
+# Registered before /{id} so "batch" is not parsed as an id
+@router.get("/batch", response_model=schemas.FriendBatchOut)
+def get_friends_batch_by_query(ids: str, db: Session = Depends(get_read_db)):
+    return get_friends_batch(parse_ids(ids), db)
+
+
+@router.post("/batch", response_model=schemas.FriendBatchOut)
+def get_friends_batch_by_body(body: schemas.FriendBatchIn, db: Session = Depends(get_read_db)):
+    return get_friends_batch(body.ids, db)
+
+
 @router.get("/{id}", response_model=schemas.FriendOut)
-def get_friend(id: int, db: Session = Depends(get_db)):
+def get_friend(id: int, db: Session = Depends(get_read_db)):
     try:
-        friend = db.query(models.Friend).filter(models.Friend.id == id).first()
+        friend = active_friends(db).filter(models.Friend.id == id).first()
         if not friend:
             raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Friend not found")
         return friend
@@ -83,10 +197,117 @@ def get_friend(id: int, db: Session = Depends(get_db)):
 
 
 @router.get("/", response_model=list[schemas.FriendOut])
-def get_friends(db: Session = Depends(get_db)):
+def get_friends(db: Session = Depends(get_read_db)):
     try:
-        friends = db.query(models.Friend).all()
+        friends = active_friends(db).order_by(models.Friend.id).all()
         return friends
     except Exception as e:
         raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR) from e
 
+
+@router.get("/{id}/similar", response_model=list[schemas.SimilarFriendOut])
+def get_similar_friends(
+        id: int,
+        max_distance: int | None = Query(None, ge=0, le=64),
+        limit: int = Query(20, ge=1, le=100),
+        db: Session = Depends(get_read_db)
+):
+    friend = active_friends(db).filter(models.Friend.id == id).first()
+    if not friend:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Friend not found")
+    if friend.photo_hash is None:
+        return []
+
+    if max_distance is None:
+        max_distance = settings.SIMILAR_HASH_DISTANCE
+    try:
+        matches = similar_friends(db, to_unsigned(friend.photo_hash), max_distance, exclude_id=id)[:limit]
+    except Exception as e:
+        raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR) from e
+
+    return [
+        schemas.SimilarFriendOut(**schemas.FriendOut.model_validate(row).model_dump(), distance=distance)
+        for row, distance in matches
+    ]
+
+
+@router.patch("/{id}", response_model=schemas.FriendOut)
+def update_friend(
+        id: int,
+        response: Response,
+        background_tasks: BackgroundTasks,
+        name: str | None = Form(None),
+        profession: str | None = Form(None),
+        profession_description: str | None = Form(None),
+        db: Session = Depends(get_db),
+        photo: UploadFile | None = File(None)
+):
+    friend = active_friends(db).filter(models.Friend.id == id).first()
+    if not friend:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Friend not found")
+
+    changes = {}
+    if name is not None:
+        changes["name"] = name
+    if profession is not None:
+        changes["profession"] = profession
+    if profession_description is not None:
+        # An empty value clears the description
+        changes["profession_description"] = profession_description or None
+
+    file_path = None
+    photo_hash = None
+    old_photo_url = friend.photo_url
+    try:
+        if photo and photo.filename:
+            file_path, changes["photo_url"], photo_hash = save_avatar(photo)
+            changes["photo_hash"] = to_signed(photo_hash) if photo_hash is not None else None
+            changes["photo_updated_at"] = datetime.now(UTC)
+
+        # Only attributes whose value differs become dirty, so the UPDATE lists just those columns
+        for column, value in changes.items():
+            if getattr(friend, column) != value:
+                setattr(friend, column, value)
+
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        if file_path is not None:
+            file_path.unlink(missing_ok=True)
+        print(f"Error updating friend {id}: {e}")
+        raise HTTPException(
+            status_code=HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Internal server error: {str(e)}"
+        ) from e
+
+    mark_write(response)
+    if file_path is not None:
+        if photo_hash is not None:
+            avatar_index.add(id, photo_hash)
+        if old_photo_url:
+            background_tasks.add_task(avatar_storage.release_avatar, old_photo_url)
+    db.refresh(friend)
+    return friend
+
+
+@router.delete("/{id}", status_code=HTTP_204_NO_CONTENT)
+def delete_friend(
+        id: int,
+        response: Response,
+        db: Session = Depends(get_db)
+):
+    friend = active_friends(db).filter(models.Friend.id == id).first()
+    if not friend:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Friend not found")
+
+    # The row keeps its avatar so a soft delete can be undone; once the row is purged the
+    # file becomes an orphan that avatar reconciliation removes
+    try:
+        friend.deleted_at = datetime.now(UTC)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"Error deleting friend {id}: {e}")
+        raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR) from e
+
+    mark_write(response)
@@ -0,0 +1,429 @@
+"""Load test for the Telegram bot against a local fake Bot API server.
+
+Starts a stand-in for the Telegram Bot API (getUpdates, sendMessage, sendPhoto,
+getFile and file downloads), a local API instance on a throwaway SQLite
+database, and the real bot process (`bot.py`, the `Application` built by
+`build_application`) pointed at both. Simulated users then walk through the
+/addfriend conversation and look the new friend up with /friend.
+
+    python benchmarks/bot_load.py
+    python benchmarks/bot_load.py --users 500 --rounds 3 --burst
+    python benchmarks/bot_load.py --backend-url http://127.0.0.1:8000
+
+Reports updates/sec and reply latency. With --burst every user sends all
+conversation steps at once instead of waiting for each reply, which is how
+ordering bugs between concurrently processed updates show up. Any unexpected,
+missing or misrouted reply, or a created friend that does not match what the
+user entered, is reported and makes the script exit non-zero.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from dataclasses import field
+from pathlib import Path
+
+import httpx
+import uvicorn
+from PIL import Image
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.responses import Response
+from starlette.routing import Route
+from startup import DUMMY_DB_ENV
+from startup import ROOT
+from startup import free_port
+
+BOT_TOKEN = "123456:LOAD-TEST"
+BACKEND_API_KEY = "load-test"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Friends", "username": "friends_load_test_bot"}
+FIRST_CHAT_ID = 10_000
+# Matches the API's MAX_BATCH_IDS default
+BATCH_SIZE = 500
+
+
+def make_photo() -> bytes:
+    buffer = io.BytesIO()
+    Image.effect_mandelbrot((128, 128), (-2.0, -1.5, 1.0, 1.5), 50).convert("RGB").save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+@dataclass
+class Reply:
+    text: str
+    at: float
+
+
+class FakeBotApi:
+    def __init__(self, photo: bytes, latency: float = 0.0) -> None:
+        self.photo = photo
+        self.latency = latency
+        self.pending: list[dict] = []
+        self.arrived = asyncio.Event()
+        self.polling = asyncio.Event()
+        self.inboxes: dict[int, asyncio.Queue[Reply]] = {}
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.delivered = 0
+        self.unknown_methods: dict[str, int] = {}
+        self.app = Starlette(routes=[
+            Route("/bot{token}/{method}", self.call, methods=["GET", "POST"]),
+            Route("/file/bot{token}/{path:path}", self.download),
+        ])
+
+    def inbox(self, chat_id: int) -> asyncio.Queue[Reply]:
+        return self.inboxes.setdefault(chat_id, asyncio.Queue())
+
+    def message(self, chat_id: int, **content) -> dict:
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"},
+            **content,
+        }
+
+    def push(self, chat_id: int, text: str | None = None, photo_id: str | None = None) -> float:
+        content = {"from": {"id": chat_id, "is_bot": False, "first_name": f"User {chat_id}"}}
+        if text is not None:
+            content["text"] = text
+            if text.startswith("/"):
+                content["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if photo_id is not None:
+            content["photo"] = [{
+                "file_id": photo_id, "file_unique_id": photo_id, "width": 128, "height": 128,
+                "file_size": len(self.photo),
+            }]
+        self.pending.append({"update_id": self.next_update_id, "message": self.message(chat_id, **content)})
+        self.next_update_id += 1
+        self.arrived.set()
+        return time.perf_counter()
+
+    async def get_updates(self, params: dict) -> list[dict]:
+        self.polling.set()
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 100))
+        deadline = time.perf_counter() + float(params.get("timeout", 0))
+        # Everything below the offset has been confirmed by the bot
+        self.pending = [update for update in self.pending if update["update_id"] >= offset]
+        while not self.pending:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return []
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), remaining)
+            except TimeoutError:
+                return []
+        updates = self.pending[:limit]
+        self.delivered += len(updates)
+        return updates
+
+    def reply(self, chat_id: int, shown: str, **content) -> dict:
+        self.inbox(chat_id).put_nowait(Reply(shown, time.perf_counter()))
+        return self.message(chat_id, **content)
+
+    async def call(self, request: Request) -> Response:
+        method = request.path_params["method"]
+        params = dict(await request.form())
+        if method != "getUpdates" and self.latency:
+            await asyncio.sleep(self.latency)
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("deleteWebhook", "setMyCommands"):
+            result = True
+        elif method == "getUpdates":
+            result = await self.get_updates(params)
+        elif method == "sendMessage":
+            result = self.reply(int(params["chat_id"]), params["text"], text=params["text"])
+        elif method == "sendPhoto":
+            await params["photo"].read()
+            caption = params.get("caption", "")
+            result = self.reply(int(params["chat_id"]), caption, caption=caption, photo=[{
+                "file_id": "sent", "file_unique_id": "sent", "width": 128, "height": 128,
+            }])
+        elif method == "getFile":
+            file_id = params["file_id"]
+            result = {
+                "file_id": file_id, "file_unique_id": file_id, "file_size": len(self.photo),
+                "file_path": f"photos/{file_id}.jpg",
+            }
+        else:
+            self.unknown_methods[method] = self.unknown_methods.get(method, 0) + 1
+            return JSONResponse({"ok": False, "error_code": 404, "description": "Not Found"}, status_code=404)
+        return JSONResponse({"ok": True, "result": result})
+
+    async def download(self, request: Request) -> Response:
+        return Response(self.photo, media_type="image/jpeg")
+
+
+class ConversationError(Exception):
+    pass
+
+
+@dataclass
+class Step:
+    text: str | None
+    expected: list[str]
+    photo: bool = False
+
+
+@dataclass
+class UserResult:
+    latencies: list[float] = field(default_factory=list)
+    created: dict[int, tuple[str, str]] = field(default_factory=dict)
+    updates: int = 0
+    error: str | None = None
+
+
+def add_friend_steps(chat_id: int, round_number: int, name: str, profession: str) -> list[Step]:
+    last_step = (
+        Step("/skip", ["Okay, skipping description.", "🎉 Successfully created friend!"])
+        if (chat_id + round_number) % 2
+        else Step(f"Description {chat_id}", ["Thank you!", "🎉 Successfully created friend!"])
+    )
+    return [
+        Step("/addfriend", ["Let's start creating a friend."]),
+        Step(None, ["Great photo!"], photo=True),
+        Step(name, ["Got it."]),
+        Step(profession, ["Almost done."]),
+        last_step,
+    ]
+
+
+async def expect(inbox: asyncio.Queue[Reply], prefix: str, timeout: float) -> Reply:
+    try:
+        reply = await asyncio.wait_for(inbox.get(), timeout)
+    except TimeoutError:
+        raise ConversationError(f"no reply within {timeout} s, expected {prefix!r}") from None
+    if not reply.text.startswith(prefix):
+        raise ConversationError(f"expected {prefix!r}, got {reply.text[:80]!r}")
+    return reply
+
+
+async def collect(api: FakeBotApi, chat_id: int, step: Step, sent_at: float, result: UserResult,
+                  timeout: float) -> Reply:
+    reply = None
+    for prefix in step.expected:
+        reply = await expect(api.inbox(chat_id), prefix, timeout)
+    result.latencies.append(reply.at - sent_at)
+    return reply
+
+
+async def run_user(api: FakeBotApi, chat_id: int, rounds: int, burst: bool, timeout: float) -> UserResult:
+    result = UserResult()
+
+    def send(step: Step, round_number: int) -> float:
+        result.updates += 1
+        photo_id = f"photo-{chat_id}-{round_number}" if step.photo else None
+        return api.push(chat_id, step.text, photo_id)
+
+    try:
+        for round_number in range(rounds):
+            name = f"Friend {chat_id}-{round_number}"
+            profession = f"Profession {chat_id}-{round_number}"
+            steps = add_friend_steps(chat_id, round_number, name, profession)
+
+            if burst:
+                sent = [send(step, round_number) for step in steps]
+                replies = [
+                    await collect(api, chat_id, step, at, result, timeout)
+                    for step, at in zip(steps, sent, strict=True)
+                ]
+            else:
+                replies = [
+                    await collect(api, chat_id, step, send(step, round_number), result, timeout) for step in steps
+                ]
+
+            created = replies[-1].text
+            if f"Name: {name}\nProfession: {profession}" not in created:
+                raise ConversationError(f"created the wrong friend: {created!r}")
+            friend_id = int(created.split("ID: ", 1)[1].split("\n", 1)[0])
+            result.created[friend_id] = (name, profession)
+
+            lookup = Step(f"/friend {friend_id}", [f"👤 *{name}*"])
+            await collect(api, chat_id, lookup, send(lookup, round_number), result, timeout)
+    except ConversationError as e:
+        result.error = f"chat {chat_id}: {e}"
+    return result
+
+
+async def verify_backend(backend_url: str, created: dict[int, tuple[str, str]]) -> list[str]:
+    errors = []
+    ids = list(created)
+    async with httpx.AsyncClient(base_url=backend_url, timeout=30) as client:
+        for start in range(0, len(ids), BATCH_SIZE):
+            response = await client.post("/friends/batch", json={"ids": ids[start:start + BATCH_SIZE]})
+            response.raise_for_status()
+            body = response.json()
+            errors += [f"friend {friend_id} was reported as created but is missing" for friend_id in body["missing"]]
+            for friend in body["friends"]:
+                if (friend["name"], friend["profession"]) != created[friend["id"]]:
+                    errors.append(f"friend {friend['id']} was stored as {friend['name']!r}, {friend['profession']!r}")
+    return errors
+
+
+def percentile(values: list[float], percent: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+def process_env(**overrides: str) -> dict[str, str]:
+    return {**DUMMY_DB_ENV, **os.environ, **overrides}
+
+
+async def wait_until_ready(url: str, process: subprocess.Popen | None, timeout: float = 30.0) -> None:
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.perf_counter() < deadline:
+            if process is not None and process.poll() is not None:
+                raise RuntimeError(f"API exited with code {process.returncode}")
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.05)
+    raise TimeoutError(f"API did not become ready within {timeout} s")
+
+
+def start_api(workdir: Path, port: int, log) -> subprocess.Popen:
+    env = process_env(
+        DATABASE_URL=f"sqlite:///{workdir / 'friends.db'}",
+        AVATAR_DIR=str(workdir / "avatars"),
+        # The bot is let through the per-client bucket with its API key, as in docker-compose
+        RATE_LIMIT_TRUSTED_API_KEYS=json.dumps([BACKEND_API_KEY]),
+        ROUTE_QUEUE_SIZE="100000",
+        ROUTE_QUEUE_TIMEOUT="120",
+    )
+    (workdir / "avatars").mkdir()
+    subprocess.run(
+        [sys.executable, "-c", "import models\nfrom database import Base, get_engine\n"
+                               "Base.metadata.create_all(get_engine())"],
+        cwd=ROOT / "app", env=env, check=True,
+    )
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=ROOT / "app", env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+
+
+def start_bot(telegram_url: str, backend_url: str, concurrency: int, log) -> subprocess.Popen:
+    env = process_env(
+        BOT_TOKEN=BOT_TOKEN,
+        TELEGRAM_API_URL=telegram_url,
+        BACKEND_BASE_URL=backend_url,
+        BACKEND_API_KEY=BACKEND_API_KEY,
+        BOT_CONCURRENT_UPDATES=str(concurrency),
+        # Per-chat throttling is covered by the unit tests; here it would only cap the throughput
+        CHAT_RATE_LIMIT="1000",
+        CHAT_RATE_BURST="1000",
+    )
+    return subprocess.Popen([sys.executable, "bot.py"], cwd=ROOT / "bot", env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def stop(process: subprocess.Popen | None) -> None:
+    if process is None or process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def run(args: argparse.Namespace, workdir: Path) -> int:
+    api = FakeBotApi(make_photo(), args.telegram_latency / 1000)
+    telegram_port = free_port()
+    server = uvicorn.Server(uvicorn.Config(api.app, host="127.0.0.1", port=telegram_port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+
+    log_path = workdir / "processes.log"
+    backend = bot = None
+    with open(log_path, "w") as log:
+        try:
+            backend_url = args.backend_url
+            if backend_url is None:
+                backend_port = free_port()
+                backend_url = f"http://127.0.0.1:{backend_port}"
+                backend = start_api(workdir, backend_port, log)
+            await wait_until_ready(f"{backend_url}/health/live", backend)
+
+            bot = start_bot(f"http://127.0.0.1:{telegram_port}", backend_url, args.concurrency, log)
+            await asyncio.wait_for(api.polling.wait(), 30)
+
+            started = time.perf_counter()
+            results = await asyncio.gather(*(
+                run_user(api, FIRST_CHAT_ID + user, args.rounds, args.burst, args.timeout)
+                for user in range(args.users)
+            ))
+            elapsed = time.perf_counter() - started
+
+            created = {friend_id: friend for result in results for friend_id, friend in result.created.items()}
+            errors = [result.error for result in results if result.error]
+            errors += await verify_backend(backend_url, created)
+            # Give late replies a moment to arrive; anything left over was not expected by the conversation
+            await asyncio.sleep(0.5)
+            errors += [
+                f"chat {chat_id}: {inbox.qsize()} unexpected extra replies"
+                for chat_id, inbox in api.inboxes.items() if not inbox.empty()
+            ]
+        finally:
+            stop(bot)
+            stop(backend)
+            server.should_exit = True
+            await server_task
+
+    latencies = sorted(latency * 1000 for result in results for latency in result.latencies)
+    updates = sum(result.updates for result in results)
+    mode = "burst" if args.burst else "interactive"
+    print(f"Users: {args.users} x {args.rounds} rounds ({mode}), bot concurrency {args.concurrency}, "
+          f"Bot API latency {args.telegram_latency:.0f} ms")
+    print(f"Updates: {updates} sent, {api.delivered} delivered in {elapsed:.2f} s "
+          f"({updates / elapsed:.1f} updates/sec)")
+    print(f"Friends created: {len(created)}")
+    if latencies:
+        print(f"Reply latency ms: p50 {percentile(latencies, 50):.1f}  p95 {percentile(latencies, 95):.1f}  "
+              f"p99 {percentile(latencies, 99):.1f}  max {latencies[-1]:.1f}")
+    if api.unknown_methods:
+        print(f"Unsupported Bot API calls: {json.dumps(api.unknown_methods)}")
+    if errors:
+        print(f"\n{len(errors)} errors (process output in {log_path}):")
+        for error in errors[:args.show_errors]:
+            print(f"  {error}")
+        return 1
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200, help="simulated chats talking to the bot at once")
+    parser.add_argument("--rounds", type=int, default=2, help="friends each user creates")
+    parser.add_argument("--burst", action="store_true", help="send all conversation steps without waiting")
+    parser.add_argument("--concurrency", type=int, default=16,
+                        help="BOT_CONCURRENT_UPDATES for the bot process (1 processes updates one by one)")
+    parser.add_argument("--telegram-latency", type=float, default=0.0,
+                        help="milliseconds the fake Bot API waits before answering, like a real round trip")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for each reply")
+    parser.add_argument("--backend-url", help="use an already running API instead of starting a local one")
+    parser.add_argument("--show-errors", type=int, default=20, help="errors to print")
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="bot_load_"))
+    return asyncio.run(run(args, workdir))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
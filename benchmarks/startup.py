@@ -0,0 +1,115 @@
+"""Cold-start benchmark for the API and bot processes.
+
+Prints a `-X importtime` summary (slowest modules by cumulative time) for each
+entry module and measures time-to-first-request of a fresh API process.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --target 1.2 --top 15
+
+Exits non-zero when time-to-first-request is above the target.
+"""
+import argparse
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+# The API needs these to build its settings; nothing connects to them during the benchmark
+DUMMY_DB_ENV = {
+    "DATABASE_HOSTNAME": "localhost",
+    "DATABASE_PORT": "5432",
+    "DATABASE_PASSWORD": "benchmark",
+    "DATABASE_NAME": "benchmark",
+    "DATABASE_USER": "benchmark",
+}
+
+# Measured ~1.0 s on a dev container; the target leaves headroom for slower CI runners
+DEFAULT_TARGET_SECONDS = 1.5
+
+
+def process_env() -> dict[str, str]:
+    return {**DUMMY_DB_ENV, **os.environ}
+
+
+def import_profile(module: str, cwd: Path) -> list[tuple[str, int, int]]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd, env=process_env(), capture_output=True, text=True, check=True,
+    )
+    # Keep the slowest entry per top-level package, so nested imports are not counted twice
+    packages: dict[str, tuple[str, int, int]] = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, _, name = match.groups()
+            package = name.split(".")[0]
+            if package not in packages or int(cumulative_us) > packages[package][2]:
+                packages[package] = (package, int(self_us), int(cumulative_us))
+    return list(packages.values())
+
+
+def print_import_report(label: str, module: str, cwd: Path, top: int) -> None:
+    rows = import_profile(module, cwd)
+    total = next((cumulative for name, _, cumulative in rows if name == module), 0)
+    print(f"\n{label}: `import {module}` took {total / 1000:.1f} ms")
+    print(f"{'module':<40} {'cumulative ms':>14} {'self ms':>10}")
+    rows = [row for row in rows if row[0] != module]
+    for name, self_us, cumulative_us in sorted(rows, key=lambda row: row[2], reverse=True)[:top]:
+        print(f"{name:<40} {cumulative_us / 1000:>14.1f} {self_us / 1000:>10.1f}")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_to_first_request(timeout: float = 30.0) -> float:
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=ROOT / "app", env=process_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/health/live", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        raise TimeoutError(f"API did not answer within {timeout} s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--top", type=int, default=10, help="modules to show per report")
+    parser.add_argument("--runs", type=int, default=3, help="cold starts to measure; the best one is reported")
+    parser.add_argument("--target", type=float, default=DEFAULT_TARGET_SECONDS,
+                        help="time-to-first-request target in seconds")
+    args = parser.parse_args()
+
+    (ROOT / "uploads" / "avatars").mkdir(parents=True, exist_ok=True)
+    print_import_report("API", "main", ROOT / "app", args.top)
+    print_import_report("Bot", "bot", ROOT / "bot", args.top)
+
+    best = min(time_to_first_request() for _ in range(args.runs))
+    status = "OK" if best <= args.target else "OVER TARGET"
+    print(f"\nAPI time-to-first-request: {best:.2f} s (target {args.target:.2f} s) {status}")
+    return 0 if best <= args.target else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,34 +1,64 @@
+import asyncio
+import weakref
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from pathlib import Path
 from typing import Any
 
 import httpx
 from config import settings
+from throttling import coalesce
 
+_clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient] = weakref.WeakKeyDictionary()
 
-async def add_friend(data: dict[str, Any], photo_bytes: bytes) -> dict[str, Any] | None:
-    files = {'photo': ('friend_photo.jpg', photo_bytes, 'image/jpeg')}
 
+@asynccontextmanager
+async def backend_client() -> AsyncIterator[httpx.AsyncClient]:
+    # Building a client loads the CA bundle, which costs more CPU than the request itself,
+    # so calls from one event loop share a client and its keep-alive connections
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        # The key lets the API tell the bot, which speaks for every chat, apart from single clients
+        headers = {"X-API-Key": settings.BACKEND_API_KEY} if settings.BACKEND_API_KEY else None
+        client = _clients[loop] = httpx.AsyncClient(headers=headers)
+    yield client
+
+
+async def close() -> None:
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def add_friend(data: dict[str, Any], photo_path: str | Path) -> dict[str, Any] | None:
     form_data = {
         'name': data['name'],
         'profession': data['profession'],
         'profession_description': data.get('profession_description', '')
     }
 
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(f"{settings.BACKEND_BASE_URL}/friends/", data=form_data, files=files)
+    # httpx reads the open file in chunks while sending, so the photo is never fully loaded in memory
+    with open(photo_path, 'rb') as photo:
+        files = {'photo': ('friend_photo.jpg', photo, 'image/jpeg')}
 
-            response.raise_for_status()
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            print(f"HTTP error when creating a friend: {e.response.status_code} - {e.response.text}")
-            return None
-        except httpx.RequestError as e:
-            print(f"Request error when creating a friend: {e}")
-            return None
+        async with backend_client() as client:
+            try:
+                response = await client.post(f"{settings.BACKEND_BASE_URL}/friends/", data=form_data, files=files)
 
+                response.raise_for_status()
+                return response.json()
+            except httpx.HTTPStatusError as e:
+                print(f"HTTP error when creating a friend: {e.response.status_code} - {e.response.text}")
+                return None
+            except httpx.RequestError as e:
+                print(f"Request error when creating a friend: {e}")
+                return None
 
+
+@coalesce
 async def get_all_friends() -> list[dict[str, Any]] | None:
-    async with httpx.AsyncClient() as client:
+    async with backend_client() as client:
         try:
             response = await client.get(f"{settings.BACKEND_BASE_URL}/friends/")
             response.raise_for_status()
@@ -38,8 +68,9 @@ async def get_all_friends() -> list[dict[str, Any]] | None:
             return None
 
 
+@coalesce
 async def get_friend_by_id(friend_id: int) -> dict[str, Any] | None:
-    async with httpx.AsyncClient() as client:
+    async with backend_client() as client:
         try:
 
             response = await client.get(f"{settings.BACKEND_BASE_URL}/friends/{friend_id}")
@@ -55,10 +86,32 @@ async def get_friend_by_id(friend_id: int) -> dict[str, Any] | None:
             return None
 
 
+# Longer id lists go in a POST body so the query string stays well under URL length limits
+MAX_BATCH_QUERY_IDS = 50
+
+
+async def get_friends_by_ids(friend_ids: list[int]) -> dict[str, Any] | None:
+    async with backend_client() as client:
+        try:
+            if len(friend_ids) <= MAX_BATCH_QUERY_IDS:
+                response = await client.get(
+                    f"{settings.BACKEND_BASE_URL}/friends/batch",
+                    params={"ids": ",".join(str(friend_id) for friend_id in friend_ids)}
+                )
+            else:
+                response = await client.post(f"{settings.BACKEND_BASE_URL}/friends/batch", json={"ids": friend_ids})
+            response.raise_for_status()
+            return response.json()
+        except (httpx.HTTPStatusError, httpx.RequestError) as e:
+            print(f"Error while getting friends {friend_ids}: {e}")
+            return None
+
+
+@coalesce
 async def get_photo_bytes(photo_url: str) -> bytes | None:
 
     url = f"{settings.BACKEND_BASE_URL}{photo_url}"
-    async with httpx.AsyncClient() as client:
+    async with backend_client() as client:
         try:
             response = await client.get(url)
             response.raise_for_status()
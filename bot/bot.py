@@ -1,4 +1,8 @@
 import logging
+import os
+import tempfile
+import time
+from pathlib import Path
 
 import api_client
 from config import settings
@@ -12,6 +16,9 @@ from telegram.ext import ConversationHandler
 from telegram.ext import MessageHandler
 from telegram.ext import filters
 from telegram.helpers import escape_markdown
+from throttling import ChatOrderedUpdateProcessor
+from throttling import ChatRateLimiter
+from throttling import rate_limited
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -19,6 +26,14 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 PHOTO, NAME, PROFESSION, DESCRIPTION = range(4)
+MAX_FRIENDS_PER_COMMAND = 10
+PHOTO_FILE_PREFIX = "friend_photo_"
+
+last_photo_sweep = 0.0
+
+chat_limiter = ChatRateLimiter(settings.CHAT_RATE_LIMIT, settings.CHAT_RATE_BURST)
+# Every requested id costs one token, so a single command can ask for at most a full burst
+max_friends_per_command = min(MAX_FRIENDS_PER_COMMAND, max(1, int(settings.CHAT_RATE_BURST)))
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -27,10 +42,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "Available commands:\n"
         "/addfriend - add a new friend\n"
         "/list - show all friends\n"
-        "/friend <id> - show a friend by ID"
+        "/friend <id> [<id> ...] - show friends by ID"
     )
 
 
+@rate_limited(chat_limiter)
 async def list_friends(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("Getting friend list from the backend...")
 
@@ -58,13 +74,29 @@ async def list_friends(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     )
 
 
+def friend_lookup_cost(update: Update, context: ContextTypes.DEFAULT_TYPE) -> float:
+    # Each id means a photo download and a message of its own
+    return min(max(1, len(context.args or [])), max_friends_per_command)
+
+
+@rate_limited(chat_limiter, cost=friend_lookup_cost)
 async def get_friend(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        friend_id = int(context.args[0])
-    except (IndexError, ValueError):
+        friend_ids = [int(arg) for arg in context.args]
+    except ValueError:
+        friend_ids = []
+    if not friend_ids:
         await update.message.reply_text("Please specify an ID. For example: /friend 123")
         return
+    if len(friend_ids) > max_friends_per_command:
+        await update.message.reply_text(f"Please specify at most {max_friends_per_command} IDs at once.")
+        return
+
+    if len(friend_ids) > 1:
+        await get_friends(update, friend_ids)
+        return
 
+    friend_id = friend_ids[0]
     friend = await api_client.get_friend_by_id(friend_id)
 
     if not friend:
@@ -74,6 +106,26 @@ async def get_friend(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         await update.message.reply_text(f"Friend with ID {friend_id} not found.")
         return
 
+    await send_friend(update, friend)
+
+
+async def get_friends(update: Update, friend_ids: list[int]) -> None:
+    # One batch request instead of one round trip per id
+    result = await api_client.get_friends_by_ids(friend_ids)
+
+    if not result:
+        await update.message.reply_text("Error: could not contact the server.")
+        return
+
+    for friend in result['friends']:
+        await send_friend(update, friend)
+
+    if result['missing']:
+        missing = ", ".join(str(friend_id) for friend_id in result['missing'])
+        await update.message.reply_text(f"Friends with these IDs were not found: {missing}")
+
+
+async def send_friend(update: Update, friend: dict) -> None:
     caption = f"👤 *{friend['name']}*\n\n"
     caption += f"💼 **Profession:** {friend['profession']}\n"
 
@@ -113,15 +165,52 @@ async def add_friend_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     return PHOTO
 
 
+def discard_photo(context: ContextTypes.DEFAULT_TYPE) -> None:
+    photo_path = context.user_data.pop('friend_photo', None)
+    if photo_path:
+        try:
+            os.remove(photo_path)
+        except FileNotFoundError:
+            pass
+
+
+def sweep_stale_photos(max_age: float) -> int:
+    # Conversations that are abandoned midway never reach submit or /cancel, so their photos are removed here
+    global last_photo_sweep
+    last_photo_sweep = time.monotonic()
+    cutoff = time.time() - max_age
+    removed = 0
+    for path in Path(tempfile.gettempdir()).glob(f"{PHOTO_FILE_PREFIX}*"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            continue
+    if removed:
+        logger.info(f"Removed {removed} photos of abandoned conversations")
+    return removed
+
+
+async def sweep_photos_on_startup(application: Application) -> None:
+    sweep_stale_photos(settings.PHOTO_MAX_AGE)
+
+
 async def get_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not update.message.photo:
         await update.message.reply_text("This is not a photo. Please send a photo.")
         return PHOTO
 
     photo_file = await update.message.photo[-1].get_file()
-    photo_bytes = await photo_file.download_as_bytearray()
 
-    context.user_data['friend_photo'] = bytes(photo_bytes)
+    # Keep the photo on disk until submission instead of holding its bytes in user_data
+    discard_photo(context)
+    if time.monotonic() - last_photo_sweep > settings.PHOTO_MAX_AGE:
+        sweep_stale_photos(settings.PHOTO_MAX_AGE)
+    fd, photo_path = tempfile.mkstemp(prefix=PHOTO_FILE_PREFIX, suffix=".jpg")
+    os.close(fd)
+    context.user_data['friend_photo'] = photo_path
+    await photo_file.download_to_drive(custom_path=photo_path)
 
     logger.info(f"Photo received from {update.effective_user.first_name}")
     await update.message.reply_text("Great photo! Now, enter the friend's name:")
@@ -187,9 +276,9 @@ async def submit_friend_to_api(update: Update, context: ContextTypes.DEFAULT_TYP
             'profession': context.user_data['friend_profession'],
             'profession_description': context.user_data.get('friend_description')
         }
-        photo = context.user_data['friend_photo']
+        photo_path = context.user_data['friend_photo']
 
-        new_friend = await api_client.add_friend(data, photo)
+        new_friend = await api_client.add_friend(data, photo_path)
 
         if new_friend:
             await update.message.reply_text(
@@ -205,11 +294,13 @@ async def submit_friend_to_api(update: Update, context: ContextTypes.DEFAULT_TYP
         logger.error(f"Error while sending data: {e}")
         await update.message.reply_text("An unknown error occurred while creating the friend.")
     finally:
+        discard_photo(context)
         context.user_data.clear()
 
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info(f"User {update.effective_user.first_name} canceled the conversation.")
+    discard_photo(context)
     context.user_data.clear()
     await update.message.reply_text(
         "Friend creation canceled.", reply_markup=ReplyKeyboardRemove()
@@ -217,8 +308,22 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return ConversationHandler.END
 
 
-def main() -> None:
-    application = Application.builder().token(settings.BOT_TOKEN).build()
+async def close_backend_client(application: Application) -> None:
+    await api_client.close()
+
+
+def build_application() -> Application:
+    builder = (
+        Application.builder()
+        .token(settings.BOT_TOKEN)
+        .base_url(f"{settings.TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{settings.TELEGRAM_API_URL}/file/bot")
+        .post_init(sweep_photos_on_startup)
+        .post_shutdown(close_backend_client)
+    )
+    if settings.BOT_CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(settings.BOT_CONCURRENT_UPDATES))
+    application = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("addfriend", add_friend_start)],
@@ -244,6 +349,12 @@ def main() -> None:
     application.add_handler(CommandHandler("list", list_friends))
     application.add_handler(CommandHandler("friend", get_friend))
 
+    return application
+
+
+def main() -> None:
+    application = build_application()
+
     logger.info("Bot is starting...")
 
     application.run_polling()
@@ -6,6 +6,12 @@ class Settings:
     def __init__(self) -> None:
         self.BOT_TOKEN: str = os.getenv("BOT_TOKEN", "")
         self.BACKEND_BASE_URL: str = os.getenv("BACKEND_BASE_URL", "http://127.0.0.1:8000")
+        self.BACKEND_API_KEY: str = os.getenv("BACKEND_API_KEY", "")
+        self.CHAT_RATE_LIMIT: float = float(os.getenv("CHAT_RATE_LIMIT", "0.5"))
+        self.CHAT_RATE_BURST: float = float(os.getenv("CHAT_RATE_BURST", "3"))
+        self.TELEGRAM_API_URL: str = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+        self.PHOTO_MAX_AGE: float = float(os.getenv("PHOTO_MAX_AGE", "3600"))
+        self.BOT_CONCURRENT_UPDATES: int = int(os.getenv("BOT_CONCURRENT_UPDATES", "16"))
 
 
 def get_settings() -> Settings:
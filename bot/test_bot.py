@@ -1,18 +1,29 @@
+import asyncio
+import os
+import tempfile
+import time
+from pathlib import Path
 from unittest.mock import AsyncMock
 from unittest.mock import Mock
 
+import api_client
 import pytest
 from config import settings
 from pytest_httpx import HTTPXMock
+from throttling import ChatOrderedUpdateProcessor
 
 from bot import NAME
 from bot import PHOTO
 from bot import PROFESSION
 from bot import add_friend_start
+from bot import cancel
+from bot import chat_limiter
+from bot import get_friend
 from bot import get_name
 from bot import get_photo
 from bot import list_friends
 from bot import start
+from bot import sweep_stale_photos
 
 settings.BACKEND_BASE_URL = "http://test-api"
 
@@ -33,7 +44,7 @@ async def test_start_command():
         "Available commands:\n"
         "/addfriend - add a new friend\n"
         "/list - show all friends\n"
-        "/friend <id> - show a friend by ID"
+        "/friend <id> [<id> ...] - show friends by ID"
     )
 
 
@@ -107,14 +118,17 @@ async def test_conversation_flow():
     update_photo = Mock()
     update_photo.message.photo = [Mock()]
     update_photo.message.photo[-1].get_file = AsyncMock()
-    update_photo.message.photo[-1].get_file.return_value.download_as_bytearray = AsyncMock(
-        return_value=b"fake_image_bytes"
-    )
+
+    async def download_to_drive(custom_path):
+        Path(custom_path).write_bytes(b"fake_image_bytes")
+
+    update_photo.message.photo[-1].get_file.return_value.download_to_drive = download_to_drive
     update_photo.message.reply_text = AsyncMock()
 
     next_state = await get_photo(update_photo, context)
 
-    assert context.user_data['friend_photo'] == b"fake_image_bytes"
+    photo_path = Path(context.user_data['friend_photo'])
+    assert photo_path.read_bytes() == b"fake_image_bytes"
 
     update_photo.message.reply_text.assert_called_with("Great photo! Now, enter the friend's name:")
 
@@ -130,3 +144,179 @@ async def test_conversation_flow():
 
     update_name.message.reply_text.assert_called_with("Got it. Now, enter their profession:")
     assert next_state == PROFESSION
+
+    update_cancel = Mock()
+    update_cancel.message.reply_text = AsyncMock()
+
+    await cancel(update_cancel, context)
+
+    assert not photo_path.exists()
+    assert context.user_data == {}
+
+
+async def test_concurrent_friend_lookups_share_one_request(httpx_mock: HTTPXMock):
+    httpx_mock.add_response(
+        method="GET",
+        url=f"{settings.BACKEND_BASE_URL}/friends/42",
+        json={"id": 42, "name": "Alice", "profession": "Tester"},
+    )
+
+    results = await asyncio.gather(*(api_client.get_friend_by_id(42) for _ in range(5)))
+
+    assert all(result["name"] == "Alice" for result in results)
+    assert len(httpx_mock.get_requests()) == 1
+
+
+async def test_get_friend_throttled_chat_gets_one_notice(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(chat_limiter, "clock", lambda: now[0])
+    monkeypatch.setattr(chat_limiter, "burst", 1.0)
+    monkeypatch.setattr(chat_limiter, "buckets", {})
+    monkeypatch.setattr(api_client, "get_friend_by_id", AsyncMock(return_value={"error": "not_found"}))
+
+    update = Mock()
+    update.effective_chat.id = 1
+    update.message.reply_text = AsyncMock()
+    context = Mock()
+    context.args = ["7"]
+
+    for _ in range(3):
+        await get_friend(update, context)
+
+    replies = [call.args[0] for call in update.message.reply_text.call_args_list]
+    assert replies[0] == "Friend with ID 7 not found."
+    assert replies[1].startswith("You're sending commands too fast.")
+    assert len(replies) == 2
+
+
+async def test_get_friend_charges_one_token_per_requested_id(monkeypatch):
+    monkeypatch.setattr(chat_limiter, "clock", lambda: 0.0)
+    monkeypatch.setattr(chat_limiter, "buckets", {})
+    get_friends_by_ids = AsyncMock(return_value={"friends": [], "missing": [1, 2, 3]})
+    monkeypatch.setattr(api_client, "get_friends_by_ids", get_friends_by_ids)
+
+    update = Mock()
+    update.effective_chat.id = 3
+    update.message.reply_text = AsyncMock()
+    context = Mock()
+    context.args = ["1", "2", "3"]
+    await get_friend(update, context)
+    context.args = ["4"]
+    await get_friend(update, context)
+
+    replies = [call.args[0] for call in update.message.reply_text.call_args_list]
+    assert replies[0] == "Friends with these IDs were not found: 1, 2, 3"
+    assert replies[1].startswith("You're sending commands too fast.")
+    assert get_friends_by_ids.await_count == 1
+
+
+async def test_get_friend_with_several_ids_uses_one_batch_request(httpx_mock: HTTPXMock):
+    httpx_mock.add_response(
+        method="GET",
+        url=f"{settings.BACKEND_BASE_URL}/friends/batch?ids=2%2C1%2C3",
+        json={
+            "friends": [
+                {"id": 2, "name": "Bob", "profession": "Dev"},
+                {"id": 1, "name": "Alice", "profession": "Tester"},
+            ],
+            "missing": [3],
+        },
+    )
+
+    update = Mock()
+    update.effective_chat.id = 2
+    update.message.reply_text = AsyncMock()
+    context = Mock()
+    context.args = ["2", "1", "3"]
+
+    await get_friend(update, context)
+
+    replies = [call.args[0] for call in update.message.reply_text.call_args_list]
+    assert "*Bob*" in replies[0]
+    assert "*Alice*" in replies[1]
+    assert replies[2] == "Friends with these IDs were not found: 3"
+    assert len(httpx_mock.get_requests()) == 1
+
+
+async def test_add_friend_streams_photo_from_file(httpx_mock: HTTPXMock, tmp_path):
+    photo_path = tmp_path / "photo.jpg"
+    photo_path.write_bytes(b"fake_image_bytes")
+    httpx_mock.add_response(
+        method="POST",
+        url=f"{settings.BACKEND_BASE_URL}/friends/",
+        json={"id": 1, "name": "Alice", "profession": "Tester"},
+        status_code=201,
+    )
+
+    result = await api_client.add_friend({"name": "Alice", "profession": "Tester"}, photo_path)
+
+    assert result["id"] == 1
+    body = httpx_mock.get_requests()[0].read()
+    assert b"fake_image_bytes" in body
+    assert b'filename="friend_photo.jpg"' in body
+
+
+async def test_update_processor_keeps_chat_order_and_runs_chats_concurrently():
+    processor = ChatOrderedUpdateProcessor(8)
+    events = []
+
+    async def handle(chat_id, step, delay):
+        events.append(("start", chat_id, step))
+        await asyncio.sleep(delay)
+        events.append(("end", chat_id, step))
+
+    def update(chat_id):
+        update = Mock()
+        update.effective_chat.id = chat_id
+        return update
+
+    # Chat 1's first step is the slowest, so only ordering keeps step 2 from finishing first
+    await asyncio.gather(
+        processor.process_update(update(1), handle(1, 1, 0.05)),
+        processor.process_update(update(1), handle(1, 2, 0)),
+        processor.process_update(update(2), handle(2, 1, 0)),
+    )
+
+    chat_1 = [event for event in events if event[1] == 1]
+    assert chat_1 == [("start", 1, 1), ("end", 1, 1), ("start", 1, 2), ("end", 1, 2)]
+    assert events.index(("end", 2, 1)) < events.index(("end", 1, 1))
+    assert processor.chat_locks == {}
+
+
+async def test_update_processor_does_not_let_a_flooding_chat_take_every_slot():
+    processor = ChatOrderedUpdateProcessor(2)
+    finished = []
+
+    async def handle(chat_id, delay):
+        await asyncio.sleep(delay)
+        finished.append(chat_id)
+
+    def update(chat_id):
+        update = Mock()
+        update.effective_chat.id = chat_id
+        return update
+
+    # Chat 1's backlog waits for its turn without holding a slot, so chat 2 gets the second one right away
+    flood = [processor.process_update(update(1), handle(1, 0.05)) for _ in range(5)]
+    await asyncio.gather(*flood, processor.process_update(update(2), handle(2, 0)))
+
+    assert finished[0] == 2
+    assert finished[1:] == [1] * 5
+    assert processor.chat_locks == {}
+
+
+async def test_sweep_stale_photos_removes_only_old_files(monkeypatch, tmp_path):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    old_photo = tmp_path / "friend_photo_old.jpg"
+    new_photo = tmp_path / "friend_photo_new.jpg"
+    other = tmp_path / "other_old.jpg"
+    for path in (old_photo, new_photo, other):
+        path.write_bytes(b"x")
+    two_hours_ago = time.time() - 7200
+    os.utime(old_photo, (two_hours_ago, two_hours_ago))
+    os.utime(other, (two_hours_ago, two_hours_ago))
+
+    assert sweep_stale_photos(3600) == 1
+    assert not old_photo.exists()
+    assert new_photo.exists()
+    assert other.exists()
@@ -0,0 +1,113 @@
+import asyncio
+import contextlib
+import functools
+import time
+
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatRateLimiter:
+    def __init__(self, rate: float, burst: float, max_chats: int = 10_000, clock=time.monotonic) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_chats = max_chats
+        self.clock = clock
+        # chat_id -> (tokens, last update, already warned)
+        self.buckets: dict[int, tuple[float, float, bool]] = {}
+
+    def hit(self, chat_id: int, cost: float = 1.0) -> tuple[bool, float, bool]:
+        # Returns (allowed, retry_after, should_notify); a throttled chat is only told once per streak
+        now = self.clock()
+        tokens, updated, warned = self.buckets.pop(chat_id, (self.burst, now, False))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if len(self.buckets) >= self.max_chats:
+            self.buckets.pop(next(iter(self.buckets)))
+
+        if tokens >= cost:
+            self.buckets[chat_id] = (tokens - cost, now, False)
+            return True, 0.0, False
+
+        self.buckets[chat_id] = (tokens, now, True)
+        return False, (cost - tokens) / self.rate, not warned
+
+
+def rate_limited(limiter: ChatRateLimiter, cost=None):
+    # cost(update, context) charges commands that fan out into several backend calls more than one token
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            chat = update.effective_chat
+            charge = cost(update, context) if cost is not None else 1.0
+            allowed, retry_after, notify = limiter.hit(chat.id if chat else None, charge)
+            if allowed:
+                return await handler(update, context)
+            if notify:
+                await update.message.reply_text(
+                    f"You're sending commands too fast. Please wait {max(1, round(retry_after))} s."
+                )
+            return None
+
+        return wrapper
+
+    return decorator
+
+
+def coalesce(func):
+    # Concurrent callers with the same arguments share one in-flight call
+    in_flight: dict[tuple, asyncio.Future] = {}
+
+    @functools.wraps(func)
+    async def wrapper(*args):
+        task = in_flight.get(args)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            in_flight[args] = task
+            task.add_done_callback(lambda _: in_flight.pop(args, None))
+        # Shield so one caller giving up does not cancel the fetch for everybody else
+        return await asyncio.shield(task)
+
+    wrapper.in_flight = in_flight
+    return wrapper
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    # Different chats are handled concurrently, but one chat's updates run one after another,
+    # so a conversation never sees its next step before the previous one has finished
+    def __init__(self, max_concurrent_updates: int) -> None:
+        super().__init__(max_concurrent_updates)
+        self.chat_locks: dict[int, asyncio.Lock] = {}
+        self.queued: dict[int, int] = {}
+
+    @contextlib.asynccontextmanager
+    async def chat_turn(self, update):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            yield
+            return
+
+        # asyncio.Lock wakes waiters in FIFO order, which keeps the chat's updates in arrival order
+        lock = self.chat_locks.setdefault(chat.id, asyncio.Lock())
+        self.queued[chat.id] = self.queued.get(chat.id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.queued[chat.id] -= 1
+            if not self.queued[chat.id]:
+                del self.queued[chat.id]
+                del self.chat_locks[chat.id]
+
+    async def process_update(self, update, coroutine) -> None:
+        # The base class takes a concurrency slot before do_process_update runs. Waiting for the
+        # chat's turn first keeps a flooding chat's backlog from occupying the slots other chats need
+        async with self.chat_turn(update):
+            await super().process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass